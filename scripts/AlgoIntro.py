@@ -53,7 +53,8 @@ class Algo_GD_FiniteDiff:
     via finite differences to approximate the gradient.
     '''
 
-    def __init__(self, w_init, t_max, step, delta, verbose, store):
+    def __init__(self, w_init, t_max, step, delta, verbose, store,
+                 central=False):
 
         # Store the user-supplied information.
         self.w = w_init
@@ -62,6 +63,7 @@ class Algo_GD_FiniteDiff:
         self.step = step
         self.delmtx = np.eye(self.w.size) * delta
         self.delta = delta
+        self.central = central # central (vs forward) differences.
         self.verbose = verbose
         self.store = store
         
@@ -102,21 +104,17 @@ class Algo_GD_FiniteDiff:
     def update(self, model):
         
         stepsize = self.step(self.t)
-        newdir = np.zeros(self.w.size, dtype=self.w.dtype)
-        w_delta = np.copy(self.w)
-        w_plus = np.copy(self.w)
-        w_minus = np.copy(self.w)
-        loss = model.l_tr(self.w)
-
-        # Perturb one coordinate at a time, compute finite difference.
-        for j in range(self.w.size):
-            
-            # Perturb one coordinate. MODEL ACCESS here.
-            delj = np.take(self.delmtx,[j],axis=1)
-            loss_delta = model.l_tr((self.w + delj))
-            
-            newdir[j] = np.mean(loss_delta-loss) / self.delta
-            
+
+        # Perturb all coordinates at once, one column per coordinate,
+        # and get all the losses in one call. MODEL ACCESS here.
+        if self.central:
+            W = np.hstack((self.w + self.delmtx, self.w - self.delmtx))
+            losses = model.l_tr_batch(W)
+            newdir = (losses[:self.w.size] - losses[self.w.size:]) / (2*self.delta)
+        else:
+            W = np.hstack((self.w, self.w + self.delmtx))
+            losses = model.l_tr_batch(W)
+            newdir = (losses[1:] - losses[0]) / self.delta
             
         self.w = self.w - stepsize * newdir.reshape(self.w.shape)
         
@@ -131,6 +129,141 @@ class Algo_GD_FiniteDiff:
         print("------------")
 
 
+class Algo_NewtonCG:
+
+    '''
+    Iterator which implements a truncated Newton method: the
+    Newton system is solved approximately by conjugate gradients,
+    using only Hessian-vector products, followed by a backtracking
+    line search. The model must provide loss_and_grad, h_tr, and
+    l_tr (e.g. logistic regression).
+    '''
+
+    def __init__(self, w_init, t_max, lam=0, cg_max=20, cg_tol=0.1,
+                 verbose=False, store=False):
+
+        # Store the user-supplied information.
+        self.w = w_init
+        self.t = None
+        self.t_max = t_max
+        self.lam = lam
+        self.cg_max = cg_max
+        self.cg_tol = cg_tol
+        self.verbose = verbose
+        self.store = store
+        
+        # If asked to store, keep record of all updates.
+        if self.store:
+            self.wstore = np.zeros((self.w.size,t_max+1), dtype=np.float64)
+            self.wstore[:,0] = self.w.flatten()
+        else:
+            self.wstore = None
+        
+
+    def __iter__(self):
+
+        self.t = 0
+
+        if self.verbose:
+            print("(via __next__)")
+            self.print_state()
+        
+        return self
+
+    
+    def __next__(self):
+
+        # Condition for stopping.
+        if self.t >= self.t_max:
+            if self.verbose:
+                print("--- Condition reached! ---")
+            raise StopIteration
+
+        self.t += 1
+
+        if self.verbose:
+            print("(via __next__)")
+            self.print_state()
+
+
+    def update(self, model):
+
+        # Loss and gradient at the current point. MODEL ACCESS here.
+        losses, g = model.loss_and_grad(self.w, lam=self.lam)
+        loss = np.mean(losses)
+        g = g.reshape(self.w.shape)
+
+        newdir = self.cg(model, g)
+
+        # Take the Newton step if the line search finds one giving
+        # sufficient decrease, else a steepest-descent step; if
+        # neither does, w is left as it is.
+        w_new = self.search(model, g, newdir, loss)
+        if w_new is None:
+            w_new = self.search(model, g, -g, loss)
+        if w_new is not None:
+            self.w = w_new
+        
+        if self.store:
+            self.wstore[:,self.t] = self.w.flatten()
+
+
+    def search(self, model, g, newdir, loss, max_halvings=30):
+        '''
+        Backtracking line search along newdir, starting from the
+        full step. Returns the first point passing the Armijo test,
+        or None if no step does (nor if newdir is not a descent
+        direction).
+        '''
+        slope = np.sum(g*newdir)
+        if not slope < 0:
+            return None
+        stepsize = 1.0
+        for i in range(max_halvings):
+            w_new = self.w + stepsize * newdir
+            if np.mean(model.l_tr(w_new, lam=self.lam)) <= loss + 1e-4*stepsize*slope:
+                return w_new
+            stepsize /= 2
+        return None
+
+
+    def cg(self, model, g):
+        '''
+        Approximately solve H p = -g by conjugate gradients,
+        stopping after cg_max steps, once the residual is small
+        relative to g, or on meeting negative curvature.
+        '''
+        p = np.zeros(g.shape, dtype=np.float64)
+        r = -g
+        d = np.copy(r)
+        rr = np.sum(r*r)
+        tol = (self.cg_tol * np.linalg.norm(g))**2
+        
+        for i in range(self.cg_max):
+            if rr <= tol:
+                break
+            Hd = model.h_tr(self.w, d, lam=self.lam) # MODEL ACCESS here.
+            dHd = np.sum(d*Hd)
+            if dHd <= 0:
+                # Not a descent direction along d; use what we have.
+                return (p if i > 0 else -g)
+            a = rr / dHd
+            p += a * d
+            r -= a * Hd
+            rr_new = np.sum(r*r)
+            d = r + (rr_new/rr) * d
+            rr = rr_new
+
+        return p
+
+
+    def print_state(self):
+        print("------------")
+        print("t =", self.t, "( max = ", self.t_max, ")")
+        print("w = ", self.w)
+        print("------------")
+
+
 def alpha_fixed(t, val):
     '''
     Step-size function: constant.
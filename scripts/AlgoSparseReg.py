@@ -1,5 +1,12 @@
 
 import numpy as np
+from scipy import sparse
+import support.models as models
+
+# Largest number of inputs for which CD switches to covariance updates
+# by itself (X'X takes d*d floats).
+COV_MAX_D = 2**12
+
 
 def soft_thres(u,mar):
     '''
@@ -15,6 +22,41 @@ def soft_thres(u,mar):
     return np.sign(u) * np.clip(a=(np.abs(u)-mar), a_min=0, a_max=None)
 
 
+def by_columns(X):
+    '''
+    X in a form suited to reading one column at a time: as it is,
+    or in CSC form if it is a scipy.sparse matrix.
+    '''
+    return (X.tocsc() if sparse.issparse(X) else X)
+
+
+def column(X, j):
+    '''
+    The jth column of X (see by_columns), as the rows it covers and
+    their values: all rows (a slice) for an array, and only the
+    stored non-zeros for a sparse matrix, so that CD updates cost
+    O(nnz) per column. Integer values are converted to float64.
+    '''
+    if sparse.issparse(X):
+        lo, hi = X.indptr[j], X.indptr[j+1]
+        rows, vals = X.indices[lo:hi], X.data[lo:hi]
+    else:
+        rows, vals = slice(None), X[:,j]
+    if np.issubdtype(vals.dtype, np.integer):
+        vals = vals.astype(np.float64)
+    return rows, vals
+
+
+def col_sqnorm(X):
+    '''
+    Squared norm of each column of X (array or scipy.sparse), in
+    float64 (so that integer inputs do not overflow).
+    '''
+    if sparse.issparse(X):
+        return np.asarray(X.astype(np.float64).power(2).sum(axis=0)).ravel()
+    return np.einsum("ij,ij->j", X, X, dtype=np.float64)
+
+
 
 
 class Algo_LASSO_CD:
@@ -23,9 +65,17 @@ class Algo_LASSO_CD:
     Coordinate descent (CD) implementation for minimization
     of the "LASSO" objective, namely the sum of squared errors
     regularized by an l1 penalty.
+
+    The residual y - Xw and the squared norm of each column of
+    X are kept between updates, so each coordinate update costs
+    O(n) rather than a full pass over X (or O(nnz) of the column,
+    if X is a scipy.sparse matrix). When there are more
+    points than inputs (n > d), "covariance" updates are used
+    instead: X'Xw is kept, using the model's cached X'X and X'y
+    (see gram()), and each update costs O(d).
     '''
 
-    def __init__(self, w_init, t_max, lam_l1, verbose):
+    def __init__(self, w_init, t_max, lam_l1, verbose, covariance=None):
 
         # Store the user-supplied information.
         self.w = np.copy(w_init)
@@ -34,11 +84,15 @@ class Algo_LASSO_CD:
         self.idxsize = self.w.size
         self.lam_l1 = lam_l1
         self.verbose = verbose
+        self.covariance = covariance # None means decide from n and d.
+        self.resid = None # computed at the first update.
+        self.sqnorm = None
     
     
     def __iter__(self):
 
         self.t = 0
+        self.resid = None
         
         # Shuffle up the indices before starting.
         self.idx = np.random.choice(self.w.size, size=self.w.size, replace=False)
@@ -63,25 +117,69 @@ class Algo_LASSO_CD:
         if self.verbose:
             print("(via __next__)")
             self.print_state()
+
+
+    def prepare(self, model):
+        '''
+        Compute the residual (or X'Xw, in covariance mode) at the
+        current parameters, and the (mean) squared norm of each
+        column. MODEL ACCESS here.
+        '''
+        X = model.X_tr
+        self.X = X
+        self.Xc = by_columns(X)
+        self.y = model.y_tr
+        n, d = X.shape
+
+        self.cov = self.covariance
+        if self.cov is None:
+            self.cov = (n > d and d <= COV_MAX_D)
+
+        if self.cov:
+            self.stats = model.gram("tr")
+            self.resid = np.dot(self.stats["XtX"], self.w).ravel() # X'Xw
+            self.sqnorm = np.diag(self.stats["XtX"]) / n
+        else:
+            self.resid = (self.y - models.mdot(X, self.w)).ravel()
+            self.sqnorm = col_sqnorm(X) / n
     
             
     def update(self, model):
 
+        if (self.resid is None or model.X_tr is not self.X
+            or model.y_tr is not self.y):
+            self.prepare(model)
+
         idx_j = self.idx[((self.t-1) % self.idxsize)] # circuits around shuffled coords.
-    
-        self.w[idx_j] = 0 # current para, but with jth coord set to zero.
-        
-        g_j = -np.mean(model.g_j_tr(j=idx_j, w=self.w, lam_l1=0))
+        w_old = self.w[idx_j,0]
+        n = self.X.shape[0]
+
+        # Correlation of the jth input with the residual of the
+        # current parameters, but with the jth coord set to zero.
+        if self.cov:
+            g_j = (self.stats["Xty"][idx_j,0] - self.resid[idx_j]) / n
+        else:
+            rows, x_j = column(self.Xc, idx_j)
+            g_j = np.dot(x_j, self.resid[rows]) / n
+        g_j += self.sqnorm[idx_j] * w_old
 
         # Compute the solution to the one-dimensional optimization,
         # using it to update the parameters.
-        self.w[idx_j] = soft_thres(u=g_j, mar=self.lam_l1)
-        # --- DB interlude start --- #
-        #print("g_j =", g_j, "/ newval =", newval, "lam_l1 =", self.lam_l1)
-        # --- DB interlude end --- #
+        if self.sqnorm[idx_j] > 0:
+            w_new = soft_thres(u=g_j, mar=self.lam_l1) / self.sqnorm[idx_j]
+        else:
+            w_new = 0.0
+        self.w[idx_j] = w_new
+
+        # Keep the residual (or X'Xw) current.
+        if w_new != w_old:
+            if self.cov:
+                self.resid += (w_new - w_old) * self.stats["XtX"][idx_j,:]
+            else:
+                self.resid[rows] -= (w_new - w_old) * x_j
         
-        # NOTE: since taking the SUM of losses rather than the mean,
-        # there is no factor of n on the "margin" value.
+        # NOTE: the objective is the mean squared error (halved) plus
+        # the l1 penalty, hence the mean in g_j and the norms.
         
         
     def print_state(self):
@@ -90,3 +188,269 @@ class Algo_LASSO_CD:
         print("Index is t =", ((self.t-1) % self.w.size), "of", self.w.size)
         print("w = ", self.w)
         print("------------")
+
+
+def lasso_path(model, lambdas, tol=1e-4, max_sweeps=1000, covariance=None,
+               w_init=None, verbose=False):
+    '''
+    Fit the LASSO (same objective as Algo_LASSO_CD) on the training
+    data of a linear model, for each of many penalty values.
+
+    The lambdas are done from largest to smallest, each starting from
+    the solution to the previous one (warm starts). At each lambda,
+    inputs are screened using the sequential strong rule, and CD
+    cycles over the inputs which survive, mostly just over the
+    non-zero ones; the KKT conditions are then checked for the inputs
+    which were screened out, and any violators are brought back in.
+    A lambda is finished once the duality gap is at most tol times
+    the objective at zero.
+    '''
+
+    # Input:
+    # lambdas is an array of m penalty values (in any order).
+    # covariance is as in Algo_LASSO_CD (None means decide from n, d).
+
+    # Output:
+    # W, a (d x m) array of the coefficients for each lambda.
+    # err, the errors (model.eval()[0]) for each lambda.
+    # spar, the number of non-zero coefficients for each lambda.
+    # (All in the same order as the lambdas given.)
+
+    lambdas = np.asarray(lambdas, dtype=np.float64).ravel()
+    X = model.X_tr
+    Xc = by_columns(X)
+    y = model.y_tr.ravel()
+    n, d = X.shape
+    m = lambdas.size
+
+    if covariance is None:
+        covariance = (n > d and d <= COV_MAX_D)
+
+    w = np.zeros(d) if w_init is None else np.array(w_init, dtype=np.float64).ravel()
+
+    # Either the residual y-Xw, or X'Xw, is kept current (see Algo_LASSO_CD).
+    if covariance:
+        stats = model.gram("tr")
+        XtX = stats["XtX"]
+        Xty = stats["Xty"].ravel()
+        yty = stats["yty"]
+        resid = np.dot(XtX, w)
+        sqnorm = np.diag(XtX) / n
+    else:
+        resid = y - models.mdot(X, w)
+        sqnorm = col_sqnorm(X) / n
+        yty = float(np.dot(y, y))
+
+    def corr():
+        # Correlations of the inputs with the residual, X'r/n.
+        if covariance:
+            return (Xty - resid) / n
+        return models.mdot(X.T, resid) / n
+
+    def sweep(todo, lam):
+        # One pass of CD over the given inputs; returns the largest
+        # decrease in the objective made by a single update.
+        biggest = 0.0
+        for j in todo:
+            if sqnorm[j] <= 0:
+                continue
+            w_old = w[j]
+            if covariance:
+                g_j = (Xty[j] - resid[j]) / n + sqnorm[j] * w_old
+            else:
+                rows, x_j = column(Xc, j)
+                g_j = np.dot(x_j, resid[rows]) / n + sqnorm[j] * w_old
+            w_new = soft_thres(u=g_j, mar=lam) / sqnorm[j]
+            if w_new != w_old:
+                w[j] = w_new
+                if covariance:
+                    resid[:] += (w_new - w_old) * XtX[j,:]
+                else:
+                    resid[rows] -= (w_new - w_old) * x_j
+                biggest = max(biggest, sqnorm[j] * (w_new - w_old)**2)
+        return biggest
+
+    def gap(lam, c):
+        # Duality gap, using the residual scaled to be dual feasible.
+        if covariance:
+            yr = yty - np.dot(w, Xty)
+            rss = yty - 2*np.dot(w, Xty) + np.dot(w, resid)
+        else:
+            yr = np.dot(y, resid)
+            rss = np.dot(resid, resid)
+        cmax = np.abs(c).max()
+        s = (min(1.0, lam/cmax) if cmax > 0 else 1.0)
+        primal = rss / (2*n) + lam * np.sum(np.abs(w))
+        dual = (2*s*yr - s*s*rss) / (2*n)
+        return primal - dual
+
+    W = np.zeros((d,m), dtype=np.float64)
+    err = np.zeros(m, dtype=np.float64)
+    spar = np.zeros(m, dtype=np.int64)
+    tol_abs = tol * yty / (2*n) # relative to the objective at w=0.
+
+    c = corr()
+    lam_prev = np.abs(c).max() # smallest lambda with all-zero solution.
+
+    for pos in np.argsort(-lambdas, kind="stable"):
+        lam = lambdas[pos]
+
+        # Sequential strong rule, keeping anything already non-zero.
+        strong = (np.abs(c) >= 2*lam - lam_prev) | (w != 0)
+        sweeps = 0
+
+        while sweeps < max_sweeps:
+
+            # Cycle over the strong set, then over the non-zero
+            # inputs until they settle.
+            sweep(np.flatnonzero(strong), lam)
+            sweeps += 1
+            while sweeps < max_sweeps:
+                sweeps += 1
+                if sweep(np.flatnonzero(w), lam) <= tol_abs:
+                    break
+
+            # KKT check over the inputs screened out.
+            c = corr()
+            viol = (~strong) & (np.abs(c) > lam)
+            if viol.any():
+                strong |= viol
+                continue
+
+            if gap(lam, c) <= tol_abs:
+                break
+
+        if verbose:
+            print("lambda =", lam, "/ sweeps =", sweeps,
+                  "/ strong =", strong.sum(), "/ non-zero =", np.count_nonzero(w))
+
+        W[:,pos] = w
+        err[pos] = np.ravel(model.eval(w.reshape((d,1))))[0]
+        spar[pos] = np.count_nonzero(w)
+        lam_prev = lam
+
+    return W, err, spar
+
+
+def lasso_multi(model, lam_l1, w_init=None, tol=1e-4, max_sweeps=1000,
+                covariance=None, verbose=False):
+    '''
+    Fit the LASSO (same objective as Algo_LASSO_CD) for many
+    responses sharing the same inputs, e.g. all the voxels loaded
+    by an Encoder (model.Y_tr, one column per voxel).
+
+    Coordinate j is updated for all voxels at once, with column
+    operations on (d x V) or (n x V) arrays. Each voxel has its own
+    penalty, and its own active set: after each full sweep, sweeps
+    are made over just the non-zero coefficients of each voxel.
+    A voxel is left alone once its duality gap is at most tol
+    times its objective at zero.
+    '''
+
+    # Input:
+    # lam_l1 is a penalty for all voxels, or an array of V of them.
+    # w_init is a (d x V) array of initial weights (default zero).
+    # covariance is as in Algo_LASSO_CD (None means decide from n, d).
+
+    # Output:
+    # A (d x V) array of the weights for all voxels.
+
+    X = model.X_tr
+    Xc = by_columns(X)
+    Y = model.Y_tr
+    n, d = X.shape
+    V = Y.shape[1]
+    lam = np.broadcast_to(np.asarray(lam_l1, dtype=np.float64), (V,))
+
+    if covariance is None:
+        covariance = (n > d and d <= COV_MAX_D)
+
+    if w_init is None:
+        W = np.zeros((d,V), dtype=np.float64)
+    else:
+        W = np.array(w_init, dtype=np.float64).reshape((d,V))
+
+    # Either the residuals Y-XW, or X'XW, are kept current.
+    XtY = models.mdot(X.T, Y).astype(np.float64)
+    yty = np.einsum("ij,ij->j", Y, Y, dtype=np.float64)
+    if covariance:
+        XtX = model.gram("tr")["XtX"]
+        resid = np.dot(XtX, W)
+        sqnorm = np.diag(XtX) / n
+    else:
+        resid = Y - models.mdot(X, W)
+        sqnorm = col_sqnorm(X) / n
+
+    def sweep(todo, active):
+        # One pass of CD over all inputs, for the voxels marked in todo (or
+        # just those of them with a non-zero jth weight, if active).
+        # Returns the largest decrease in the objective of any voxel.
+        biggest = 0.0
+        alltodo = np.flatnonzero(todo)
+        for j in range(d):
+            if sqnorm[j] <= 0:
+                continue
+            vs = (np.flatnonzero(todo & (W[j,:] != 0)) if active else alltodo)
+            if vs.size == 0:
+                continue
+            if vs.size == V:
+                vs = slice(None) # a view, rather than a copy.
+            w_old = W[j,vs]
+            if covariance:
+                g_j = (XtY[j,vs] - resid[j,vs]) / n + sqnorm[j] * w_old
+            else:
+                rows, x_j = column(Xc, j)
+                sub = ((rows, vs) if isinstance(rows, slice) or isinstance(vs, slice)
+                       else np.ix_(rows, vs))
+                g_j = np.dot(x_j, resid[sub]) / n + sqnorm[j] * w_old
+            w_new = soft_thres(u=g_j, mar=lam[vs]) / sqnorm[j]
+            delta = w_new - w_old
+            if not delta.any():
+                continue
+            W[j,vs] = w_new
+            if covariance:
+                resid[:,vs] += np.outer(XtX[:,j], delta)
+            else:
+                resid[sub] -= np.outer(x_j, delta)
+            biggest = max(biggest, sqnorm[j] * np.max(delta**2))
+        return biggest
+
+    def gaps():
+        # Duality gap of each voxel (see lasso_path).
+        if covariance:
+            C = (XtY - resid) / n
+            yr = yty - np.einsum("ij,ij->j", W, XtY)
+            rss = yty - 2*np.einsum("ij,ij->j", W, XtY) + np.einsum("ij,ij->j", W, resid)
+        else:
+            C = models.mdot(X.T, resid) / n
+            yr = np.einsum("ij,ij->j", Y, resid)
+            rss = np.einsum("ij,ij->j", resid, resid)
+        cmax = np.abs(C).max(axis=0)
+        s = np.minimum(1.0, lam / np.where(cmax > 0, cmax, np.inf))
+        s[cmax == 0] = 1.0
+        primal = rss / (2*n) + lam * np.sum(np.abs(W), axis=0)
+        dual = (2*s*yr - s*s*rss) / (2*n)
+        return primal - dual
+
+    tol_abs = tol * yty / (2*n) # relative to the objective at w=0.
+    done = np.zeros(V, dtype=bool)
+    sweeps = 0
+
+    while sweeps < max_sweeps and not done.all():
+
+        todo = ~done
+        sweep(todo, active=False)
+        sweeps += 1
+
+        # Then cycle over each voxel's non-zero weights until they settle.
+        while sweeps < max_sweeps:
+            sweeps += 1
+            if sweep(todo, active=True) <= tol_abs[todo].min():
+                break
+
+        done = (gaps() <= tol_abs)
+
+        if verbose:
+            print("sweeps =", sweeps, "/ voxels done:", done.sum(), "of", V)
+
+    return W
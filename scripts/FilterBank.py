@@ -3,6 +3,7 @@ import math
 import numpy as np
 from scipy import signal
 from skimage import color as col
+from skimage import util
 from scipy import ndimage as ndi
 
 
@@ -230,7 +231,7 @@ def patch_stats(image, grid_w, grid_h):
                 stop_w = start_w + dw
             
             patch = image[start_h:stop_h, start_w:stop_w]
-            meanvec[idx] = np.mean(patch) # patch mean
+            meanvec[idx] = np.mean(patch, dtype=np.float64) # patch mean
             medvec[idx] = np.median(patch) # patch median
             maxvec[idx] = np.max(patch) # patch maximum
             minvec[idx] = np.min(patch) # patch minimum
@@ -257,12 +258,20 @@ def nonlin(u):
 
 
 
-def G2_getfeatures(ims, fil_paras, gridshape, mode="reflect", cval=0):
+def G2_getfeatures(ims, fil_paras, gridshape, mode="reflect", cval=0,
+                   dtype=np.float64):
     '''
     A routine which takes an array of images with 4 coords.
     Dim 1 and 2: pixel position.
     Dim 3: RGB channel index.
     Dim 4: Time index.
+
+    The colour conversion and convolutions are done in the given
+    dtype (np.float32 halves the memory traffic); patch means are
+    accumulated in float64 either way. Features are float32.
+    Integer images (e.g. uint8 frames from stimuli.read_frames) are
+    scaled to [0,1] first, as skimage does, so they give the same
+    features as the equivalent float images.
     '''
     
     num_ims = ims.shape[3]
@@ -272,6 +281,8 @@ def G2_getfeatures(ims, fil_paras, gridshape, mode="reflect", cval=0):
     
     # Generate the kernel prior to loop over images.
     fil_values = fil_kernel(paras=fil_paras, n_stds=2)
+    fil_real = fil_values["real"].astype(dtype)
+    fil_imag = fil_values["imag"].astype(dtype)
     
     # Iterate over images.
     for i in range(num_ims):
@@ -279,14 +290,18 @@ def G2_getfeatures(ims, fil_paras, gridshape, mode="reflect", cval=0):
         featvec = np.arange(0, dtype=np.float32)
         
         # Slice -> XYZ -> CIE Lab -> Take only Luminance channel.
-        im = col.xyz2lab(col.rgb2xyz(ims[:,:,:,i]))[:,:,0]
+        frame = util.img_as_float(ims[:,:,:,i]).astype(dtype, copy=False)
+        im = col.xyz2lab(col.rgb2xyz(frame))[:,:,0]
+        im = im.astype(dtype, copy=False)
         
         # Convolution.
         fil_response_real = ndi.convolve(input=im,
-                                         weights=fil_values["real"],
+                                         weights=fil_real,
+                                         output=dtype,
                                          mode=mode, cval=cval)
         fil_response_imag = ndi.convolve(input=im,
-                                         weights=fil_values["imag"],
+                                         weights=fil_imag,
+                                         output=dtype,
                                          mode=mode, cval=cval)
         fil_response_magnitude = np.sqrt((fil_response_real**2 + fil_response_imag**2))
         
@@ -0,0 +1,138 @@
+'''
+Fit the LASSO encoder for many voxels in parallel.
+
+The inputs (X_tr and X_te) are read once, in the main process, and
+placed in shared memory; a pool of worker processes attaches to them
+at start-up, so they are never pickled. Each task is a range of
+voxels: the worker builds an Encoder for just those voxels (which
+memory-maps only their rows of the response files), fits them all
+together with AlgoSparseReg.lasso_multi, and sends back their
+weights, test correlations, and sparsity, which are written into
+preallocated arrays as they arrive.
+
+USAGE (e.g. from a notebook):
+  W, corr, spar = VoxelPool.fit_voxels(dinfo, voxels, lam_l1=0.05)
+'''
+
+import copy
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import support.models as models
+import scripts.AlgoSparseReg as asr
+
+VOXEL_CHUNK = 256 # voxels per task.
+
+# Set in each worker by attach().
+shared = {}
+
+
+def to_shared(arr):
+    '''
+    Copy an array into a new block of shared memory. Returns the
+    block, and a description from which workers can attach to it.
+    '''
+    shm = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+    out = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+    out[...] = arr
+    return shm, {"name": shm.name, "shape": arr.shape, "dtype": arr.dtype.str}
+
+
+def attach(dinfo, descs, lam_l1, tol, max_sweeps):
+    '''
+    Pool initializer: attach to the shared inputs.
+    '''
+    shared["dinfo"] = dinfo
+    shared["lam_l1"] = lam_l1
+    shared["tol"] = tol
+    shared["max_sweeps"] = max_sweeps
+    shared["blocks"] = []
+    for name, desc in descs.items():
+        shm = shared_memory.SharedMemory(name=desc["name"])
+        shared["blocks"].append(shm) # keep the mapping open.
+        shared[name] = np.ndarray(desc["shape"], dtype=np.dtype(desc["dtype"]),
+                                  buffer=shm.buf)
+
+
+def fit_task(args):
+    '''
+    Fit one range of voxels, given by positions in the voxel list.
+    '''
+    start, stop, voxels = args
+    dinfo = copy.copy(shared["dinfo"])
+    dinfo.misc = dict(dinfo.misc)
+    dinfo.misc["voxidx"] = voxels
+
+    # Only these voxels' responses are read; the inputs are shared.
+    mod = models.Encoder(dinfo, mode="mmap")
+    mod.X_tr = shared["X_tr"]
+    mod.X_te = shared["X_te"]
+
+    W = asr.lasso_multi(mod, shared["lam_l1"][start:stop], tol=shared["tol"],
+                        max_sweeps=shared["max_sweeps"])
+
+    corr = models.corr_cols(np.dot(mod.X_te, W), mod.Y_te)
+    spar = np.count_nonzero(W, axis=0)
+    return start, stop, W, corr, spar
+
+
+def fit_voxels(dinfo, voxels, lam_l1, nproc=None, chunk=VOXEL_CHUNK,
+               tol=1e-4, max_sweeps=1000):
+    '''
+    Fit the LASSO for each of the given voxels, with a pool of
+    nproc processes (default: all cores).
+    '''
+
+    # Input:
+    # dinfo is the encoder's data info (its voxidx is not used).
+    # voxels is an array of V voxel indices (rows of the response files).
+    # lam_l1 is a penalty for all voxels, or an array of V of them.
+
+    # Output:
+    # W, a (d x V) array of weights, one column per voxel.
+    # corr, the test correlation of each voxel's predictions.
+    # spar, the number of non-zero weights of each voxel.
+
+    voxels = np.atleast_1d(voxels).astype(np.intp)
+    V = voxels.size
+
+    # Read the inputs once, into shared memory.
+    dinfo = copy.copy(dinfo)
+    dinfo.misc = dict(dinfo.misc)
+    dinfo.misc["voxidx"] = voxels[:1]
+    mod = models.Encoder(dinfo, mode="mmap")
+    blocks = []
+    descs = {}
+    try:
+        for name in ("X_tr", "X_te"):
+            shm, descs[name] = to_shared(getattr(mod, name))
+            blocks.append(shm)
+        d = mod.d
+        del mod
+
+        W = np.zeros((d,V), dtype=np.float64)
+        corr = np.zeros(V, dtype=np.float64)
+        spar = np.zeros(V, dtype=np.int64)
+
+        todo = [(i, min(i+chunk, V), voxels[i:(i+chunk)])
+                for i in range(0, V, chunk)]
+        lam = np.broadcast_to(np.asarray(lam_l1, dtype=np.float64), (V,))
+
+        done = 0
+        with multiprocessing.Pool(processes=nproc, initializer=attach,
+                                  initargs=(dinfo, descs, lam, tol,
+                                            max_sweeps)) as pool:
+            for start, stop, W_k, corr_k, spar_k in pool.imap_unordered(
+                    fit_task, todo):
+                W[:,start:stop] = W_k
+                corr[start:stop] = corr_k
+                spar[start:stop] = spar_k
+                done += stop - start
+                print("Update:", done, "of", V, "voxels")
+
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    return W, corr, spar
@@ -0,0 +1,122 @@
+'''
+Benchmark of the old (full X.w per coordinate) and new (residual
+kept between updates) coordinate descent for the LASSO, as used by
+scripts/AlgoSparseReg.py. Run on the NoisyOpt_SmallSparse data, and
+on synthetic features shaped like those of the encoder (7200 time
+points, standardized and clipped as in the encoder notebook). Also
+compares a 150-point LASSO path done as in the notebooks (a new
+Algo_LASSO_CD per lambda) with lasso_path().
+
+USAGE (from the top directory): python -m scripts.bench_cd [d] [sweeps]
+'''
+
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import support.container as container
+import support.parse_data as dp
+import support.parse_model as mp
+import scripts.AlgoSparseReg as asr
+
+
+def run_old(model, w_init, t_max, lam_l1):
+    '''
+    The original update: set the coordinate to zero, then get
+    its gradient from the full data via model.g_j_tr.
+    '''
+    w = np.copy(w_init)
+    idx = np.random.choice(w.size, size=w.size, replace=False)
+    for t in range(1, t_max+1):
+        idx_j = idx[((t-1) % w.size)]
+        w[idx_j] = 0
+        g_j = -np.mean(model.g_j_tr(j=idx_j, w=w, lam_l1=0))
+        w[idx_j] = asr.soft_thres(u=g_j, mar=lam_l1)
+    return w
+
+
+def run_new(model, w_init, t_max, lam_l1):
+    al = asr.Algo_LASSO_CD(w_init=w_init, t_max=t_max,
+                           lam_l1=lam_l1, verbose=False)
+    for mystep in al:
+        al.update(model)
+    return al.w
+
+
+def encoder_like(path, n, d):
+    '''
+    Synthetic standardized, clipped features and a sparse response.
+    '''
+    X = np.random.normal(size=(n,d)).astype(np.float32)
+    X = X / np.std(X, axis=0)
+    X = np.clip(X, -1, 1)
+    k = n // 10 # held out for testing.
+    X = (X - np.mean(X[k:], axis=0)) / np.std(X[k:], axis=0)
+    w = np.zeros((d,1), dtype=np.float32)
+    w[np.random.choice(d, size=d//20, replace=False)] = 1
+    y = np.dot(X, w) + np.random.normal(size=(n,1)).astype(np.float32)
+    container.write(path, {"X_tr": X[k:], "y_tr": y[k:],
+                           "X_te": X[:k], "y_te": y[:k]}, mname="LinReg")
+    return container.info(path)
+
+
+def compare(name, model, d, sweeps, lam_l1):
+    w_init = np.zeros((d,1))
+    t_max = sweeps * d
+
+    np.random.seed(0)
+    t0 = time.perf_counter()
+    w_old = run_old(model, w_init, t_max, lam_l1)
+    t_old = time.perf_counter() - t0
+
+    np.random.seed(0)
+    t0 = time.perf_counter()
+    w_new = run_new(model, w_init, t_max, lam_l1)
+    t_new = time.perf_counter() - t0
+
+    print(name, "( d =", d, ", sweeps =", sweeps, ")")
+    print("  old:", round(t_old, 4), "s")
+    print("  new:", round(t_new, 4), "s", "( x", round(t_old/t_new, 1), ")")
+    print("  max |w_old - w_new| =", np.abs(w_old - w_new).max())
+
+
+def compare_path(model, d, num_lam=150, t_max=1000):
+    lam_max = np.abs(np.dot(model.y_tr.ravel(), model.X_tr)).max() / model.n
+    todo_lambda = np.logspace(np.log10(lam_max), np.log10(lam_max/1000), num_lam)
+
+    t0 = time.perf_counter()
+    w_init = np.zeros((d,1))
+    for lam in todo_lambda:
+        w_init = run_new(model, w_init, t_max, lam)
+    t_loop = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    W, err, spar = asr.lasso_path(model, todo_lambda)
+    t_path = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    run_new(model, np.zeros((d,1)), 20*d, todo_lambda[-1])
+    t_cold = time.perf_counter() - t0
+
+    print("LASSO path (", num_lam, "lambdas, d =", d, ")")
+    print("  one CD per lambda (t_max =", t_max, "):", round(t_loop, 4), "s")
+    print("  lasso_path:", round(t_path, 4), "s")
+    print("  (one cold fit, 20 sweeps, smallest lambda:", round(t_cold, 4), "s )")
+
+
+if __name__ == "__main__":
+
+    d = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    sweeps = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        dinfo = dp.NoisyOpt_SmallSparse(towrite=os.path.join(tmp, "ss.lmd"))
+        model = mp.model(dinfo)
+        compare("NoisyOpt_SmallSparse", model, model.d, 50, 0.1)
+
+        dinfo = encoder_like(os.path.join(tmp, "enc.lmd"), 7200, d)
+        model = mp.model(dinfo)
+        compare("Encoder-like features", model, d, sweeps, 0.05)
+        compare_path(model, d)
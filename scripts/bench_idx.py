@@ -0,0 +1,105 @@
+'''
+Benchmark of the old (byte-at-a-time) and new (bulk) IDX readers
+used by parse_data.MNIST(). A synthetic IDX file of MNIST training
+size is written to a temporary directory, both as raw and gzipped.
+
+USAGE (from the top directory): python -m scripts.bench_idx [n]
+'''
+
+import gzip
+import os
+import struct
+import sys
+import tempfile
+import time
+import numpy as np
+import support.parse_data as dp
+
+
+def read_bytewise(toread, towrite):
+    '''
+    The original reader: header by hand, then one byte per
+    Python-level iteration.
+    '''
+    with open(toread, mode="rb") as f_bin:
+
+        f_bin.seek(4)
+        b = f_bin.read(4)
+        n = int.from_bytes(b, byteorder="big")
+        b = f_bin.read(4)
+        d_rows = int.from_bytes(b, byteorder="big")
+        b = f_bin.read(4)
+        d_cols = int.from_bytes(b, byteorder="big")
+        d = d_rows * d_cols
+
+        with open(towrite, mode="bw") as g_bin:
+
+            bytes_left = n * d
+            idx = 0
+            data_arr = np.empty( (n*d), dtype=np.uint8 )
+            while bytes_left > 0:
+                b = f_bin.read(1)
+                data_arr[idx] = np.uint8(int.from_bytes(b, byteorder="big"))
+                bytes_left -= 1
+                idx += 1
+
+            data_arr.tofile(g_bin)
+
+
+def write_idx(path, data_arr, compress=False):
+    '''
+    Write a uint8 array in IDX format.
+    '''
+    header = bytes([0, 0, 0x08, data_arr.ndim])
+    header += struct.pack(">" + "I"*data_arr.ndim, *data_arr.shape)
+    opener = gzip.open if compress else open
+    with opener(path, mode="wb") as f:
+        f.write(header)
+        f.write(data_arr.tobytes())
+
+
+def read_bulk(toread, towrite, shape):
+    '''
+    The new reader, streaming into a memory-mapped output.
+    '''
+    out = np.memmap(towrite, dtype=np.uint8, mode="w+", shape=shape)
+    dp.idx_into(toread, out)
+    out.flush()
+    del out
+
+
+def timeit(fn, *args):
+    t0 = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - t0
+
+
+if __name__ == "__main__":
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 60000
+    data_arr = np.random.randint(0, 256, size=(n,28,28), dtype=np.uint8)
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        raw = os.path.join(tmp, "images-idx3-ubyte")
+        gz = raw + ".gz"
+        out = os.path.join(tmp, "X.dat")
+        write_idx(raw, data_arr)
+        write_idx(gz, data_arr, compress=True)
+
+        print("IDX payload:", data_arr.shape, "(", data_arr.nbytes, "bytes )")
+
+        t = timeit(read_bulk, raw, out, data_arr.shape)
+        assert np.array_equal(np.fromfile(out, dtype=np.uint8), data_arr.ravel())
+        print("new, raw   :", round(t, 4), "s")
+
+        t = timeit(read_bulk, gz, out, data_arr.shape)
+        assert np.array_equal(np.fromfile(out, dtype=np.uint8), data_arr.ravel())
+        print("new, gzip  :", round(t, 4), "s")
+
+        t = timeit(dp.idx_read, gz)
+        print("new, gzip (to array):", round(t, 4), "s")
+
+        t = timeit(read_bytewise, raw, out)
+        assert np.array_equal(np.fromfile(out, dtype=np.uint8), data_arr.ravel())
+        print("old, raw   :", round(t, 4), "s")
@@ -0,0 +1,26 @@
+'''
+Check that FilterBank.G2_getfeatures gives the same features for
+uint8 frames (as returned by support/stimuli.py) as for the same
+frames given as floats in [0,1], in both float64 and float32.
+
+USAGE (from the top directory): python -m scripts.check_features
+'''
+
+import numpy as np
+import scripts.FilterBank as fb
+
+
+if __name__ == "__main__":
+
+    ims = np.random.default_rng(0).integers(0, 256, size=(48,48,3,10),
+                                            dtype=np.uint8)
+    paras = {"freqs": 0.1, "dir": 0.5, "amp": 1, "sdev": 3, "phase": 0}
+
+    for dtype, tol in ((np.float64, 1e-6), (np.float32, 1e-3)):
+        a = fb.G2_getfeatures(ims, paras, (4,4), dtype=dtype)
+        b = fb.G2_getfeatures(ims / 255, paras, (4,4), dtype=dtype)
+        diff = np.abs(a - b).max()
+        print(np.dtype(dtype).name, ": max |uint8 - float/255| =", diff)
+        assert diff <= tol * max(1, np.abs(b).max()), "features differ"
+
+    print("OK")
@@ -8,9 +8,12 @@ from matplotlib import pyplot as plt
 # Open file connection.
 f = tables.open_file("../data/vim-2/Stimuli.mat", mode="r")
 
-# Get object and array.
+frames_to_play = 500
+
+# Get object, and read only the frames to be played (a slice of the
+# node reads just the HDF5 chunks it covers; see support/stimuli.py).
 stimulus_object = f.get_node(where="/", name="sv")
-stimulus_array = stimulus_object.read()
+stimulus_array = stimulus_object[0:frames_to_play]
 
 # Iterate over the time dimension to "play a video".
 num_frames = stimulus_array.shape[0]
@@ -18,8 +21,6 @@ num_channels = stimulus_array.shape[1]
 frame_w = stimulus_array.shape[2]
 frame_h = stimulus_array.shape[3]
 
-frames_to_play = 500
-
 oneframe = np.zeros(num_channels*frame_h*frame_w, dtype=np.uint8).reshape((frame_h, frame_w, num_channels))
 im = plt.imshow(oneframe)
 
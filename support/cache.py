@@ -0,0 +1,205 @@
+'''
+A content-addressed cache of prepared data sets.
+
+Each entry is a container file (see support/container.py), stored
+under CACHE_PATH with a name given by a hash of the data set name,
+the size, modification time, and content digest of every source
+file, and the parameters passed to the preparation function. An
+index file records the entries and when each was last used, so that
+the least recently used ones can be evicted once the total size of
+the cache goes over its budget.
+
+Content digests are themselves remembered per (path, size, mtime),
+so a lookup on unchanged sources only needs to stat them. Likewise,
+the checksums of a cached container are checked the first time it
+is used (and again whenever it has been modified since), and the
+result is recorded in the index.
+'''
+
+import support.container as container
+import hashlib
+import json
+import os
+import time
+
+CACHE_PATH = os.path.join("data", "cache")
+CACHE_VERSION = 2 # bump to invalidate all entries.
+DIGEST_BLOCK = 2**24 # bytes per block when hashing source files.
+
+# Disk budget (bytes) for all entries together; can be set from the
+# environment, or per call.
+BUDGET = int(os.environ.get("LEARNML_CACHE_BUDGET", 8 * 2**30))
+
+
+def index_path():
+    return os.path.join(CACHE_PATH, "index.json")
+
+
+def read_index():
+    '''
+    The cache index, or an empty one if there is none yet.
+    '''
+    try:
+        with open(index_path(), mode="r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"entries": {}, "digests": {}}
+
+
+def write_index(index):
+    '''
+    Write the index, atomically replacing the old one.
+    '''
+    os.makedirs(CACHE_PATH, exist_ok=True)
+    towrite = index_path() + ".tmp"
+    with open(towrite, mode="w") as f:
+        json.dump(index, f, sort_keys=True, indent=1)
+    os.replace(towrite, index_path())
+
+
+def file_digest(path, index):
+    '''
+    Size, modification time, and content digest of a file. The
+    digest is only recomputed when the size or mtime has changed.
+    '''
+    st = os.stat(path)
+    path = os.path.abspath(path)
+    known = index["digests"].get(path)
+    if known and known["size"] == st.st_size and known["mtime_ns"] == st.st_mtime_ns:
+        return known
+
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, mode="rb") as f:
+        while True:
+            b = f.read(DIGEST_BLOCK)
+            if not b:
+                break
+            h.update(b)
+
+    known = {"size": st.st_size,
+             "mtime_ns": st.st_mtime_ns,
+             "digest": h.hexdigest()}
+    index["digests"][path] = known
+    return known
+
+
+def make_key(dataset, sources, params, index):
+    '''
+    The cache key for a data set built from the given source files
+    and preparation parameters.
+    '''
+    desc = {"version": [CACHE_VERSION, container.VERSION],
+            "dataset": dataset,
+            "sources": [file_digest(p, index) for p in sources],
+            "params": params}
+    b = json.dumps(desc, sort_keys=True, default=repr).encode("utf-8")
+    return hashlib.sha256(b).hexdigest()
+
+
+def entry_path(key):
+    return os.path.join(CACHE_PATH, key + ".lmd")
+
+
+def valid(key, index):
+    '''
+    Whether the entry for the key is intact: its file has the size
+    recorded, and (unless already done for the file as it is now)
+    its checksums are correct. Broken entries are dropped.
+    '''
+    entry = index["entries"][key]
+    path = entry_path(key)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        st = None
+    if st is None or st.st_size != entry["nbytes"]:
+        del index["entries"][key]
+        return False
+    if entry.get("verified") != st.st_mtime_ns:
+        try:
+            container.read(path, verify=True)
+        except ValueError as e:
+            print("Dropping cache entry", key[:12], "(", e, ")")
+            del index["entries"][key]
+            return False
+        entry["verified"] = st.st_mtime_ns
+    return True
+
+
+def lookup(key, index):
+    '''
+    Path to a valid cached container for the key (marking it as
+    just used), or None.
+    '''
+    if key not in index["entries"] or not valid(key, index):
+        return None
+    index["entries"][key]["atime"] = time.time()
+    return entry_path(key)
+
+
+def latest(dataset):
+    '''
+    Path to the most recently used valid entry for a data set, or None.
+    '''
+    index = read_index()
+    found = sorted(((e["atime"], key) for key, e in index["entries"].items()
+                    if e["dataset"] == dataset), reverse=True)
+    path = None
+    for atime, key in found:
+        if valid(key, index):
+            path = entry_path(key)
+            break
+    write_index(index)
+    return path
+
+
+def store(key, dataset, index, budget=None):
+    '''
+    Record a newly built entry, then evict least recently used
+    entries until the cache fits within the budget.
+    '''
+    budget = (BUDGET if budget is None else budget)
+    st = os.stat(entry_path(key))
+    index["entries"][key] = {"dataset": dataset,
+                             "nbytes": st.st_size,
+                             "verified": st.st_mtime_ns, # just built.
+                             "atime": time.time()}
+
+    total = sum(e["nbytes"] for e in index["entries"].values())
+    byage = sorted(index["entries"].items(), key=lambda kv: kv[1]["atime"])
+    for old, entry in byage:
+        if total <= budget:
+            break
+        if old == key:
+            continue
+        print("Evicting", entry["dataset"], "cache entry", old[:12], "...")
+        try:
+            os.remove(entry_path(old))
+        except FileNotFoundError:
+            pass
+        total -= entry["nbytes"]
+        del index["entries"][old]
+
+
+def get(dataset, build, sources, params, budget=None, exec_params=None):
+    '''
+    Return a data info object for the data set, built by calling
+    build(towrite=<path>, **params, **exec_params) only if no valid
+    cached copy exists for the current sources and parameters. The
+    exec_params (e.g. the number of processes) do not change the
+    data, so they are passed to build but left out of the key.
+    '''
+    index = read_index()
+    key = make_key(dataset, sources, params, index)
+    path = lookup(key, index)
+
+    if path is None:
+        os.makedirs(CACHE_PATH, exist_ok=True)
+        path = entry_path(key)
+        build(towrite=path, **params, **(exec_params or {}))
+        store(key, dataset, index, budget=budget)
+    else:
+        print("Using cached", dataset, "(", key[:12], ")...")
+
+    write_index(index)
+    return container.info(path)
@@ -1,6 +1,10 @@
 
 import numpy as np
+from scipy import sparse
+import concurrent.futures
+import queue
 import sys
+import threading
 
 
 class Redirect:
@@ -27,19 +31,27 @@ class DataInfo:
 
     def __init__(self):
 
-        # Shape, path, and data type of train/test in/outputs.
+        # Shape, path, and data type of train/test in/outputs. The
+        # offset is the position (in bytes) of the array in its file.
+        # Splits stored in CSR form also have "format": "csr", and
+        # "parts", giving one such dictionary per part (indptr,
+        # indices, data).
         self.X_tr = {"shape": None,
                      "path": None,
-                     "dtype": None}
+                     "dtype": None,
+                     "offset": 0}
         self.X_te = {"shape": None,
                      "path": None,
-                     "dtype": None}
+                     "dtype": None,
+                     "offset": 0}
         self.y_tr = {"shape": None,
                      "path": None,
-                     "dtype": None}
+                     "dtype": None,
+                     "offset": 0}
         self.y_te = {"shape": None,
                      "path": None,
-                     "dtype": None}
+                     "dtype": None,
+                     "offset": 0}
         # Desired model name.
         self.mname = None
         # A dictionary for holding anything needed at runtime.
@@ -57,62 +69,284 @@ class DataInfo:
         return out
 
         
+LOADER = None
+
+
+def loader(nthreads):
+    '''
+    The thread pool shared by all background loads.
+    '''
+    global LOADER
+    if LOADER is None:
+        LOADER = concurrent.futures.ThreadPoolExecutor(max_workers=nthreads)
+    return LOADER
+
+
 class Data:
     '''
     A general data class, assumed to be given a data info
     object with dictionaries containing the path and shape
     information of data to be used in the final routine.
+
+    Each split is only opened the first time it is accessed.
+    Under mode "auto" (the default), files of at least MMAP_MIN
+    bytes are returned as read-only memory maps, and smaller
+    files are read into memory. Modes "mmap" and "read" force
+    one or the other.
+
+    With background=True, all splits start loading at once in a
+    pool of threads, and accessing a split only waits for that
+    split's read to finish.
+
+    Splits stored in CSR form are opened as scipy.sparse matrices,
+    with each of their parts opened as above.
+
+    If a dtype is given (e.g. np.float32), the splits in CAST are
+    converted to it as they are opened, if stored otherwise (except
+    for integer splits, when KEEP_INT is set). Memory-mapped splits
+    are left as stored, since converting them would read them whole
+    into memory: only the blocks read from them by read_rows and
+    batches are converted, and whole-split computations keep the
+    stored precision. To memory-map float32 splits, prepare the
+    data in float32 (parse_data.prep(..., dtype=np.float32)).
     '''
 
-    def __init__(self, dinfo):
+    SPLITS = ("X_tr", "X_te", "y_tr", "y_te")
+    MMAP_MIN = 2**24 # files this large (in bytes) are memory-mapped.
+    LOAD_THREADS = 4 # size of the thread pool for background loads.
+    NO_BACKGROUND = () # splits never loaded in the background.
+    CAST = ("X_tr", "X_te") # splits converted to dtype, if one is given.
+    KEEP_INT = False # leave integer splits as stored.
 
-        # Inputs, training.
-        myd = dinfo.X_tr
-        if myd:
-            with open(myd["path"], mode="br") as f:
-                myar = np.fromfile(file=f, dtype=myd["dtype"])
-                self.X_tr = myar.reshape(myd["shape"])
-        else:
-            self.X_tr = None
-
-        # Inputs, testing.
-        myd = dinfo.X_te
-        if myd:
-            with open(myd["path"], mode="br") as f:
-                myar = np.fromfile(file=f, dtype=myd["dtype"])
-                self.X_te = myar.reshape(myd["shape"])
-        else:
-            self.X_te = None
-            
-        # Outputs, training.
-        myd = dinfo.y_tr
-        if myd:
-            with open(myd["path"], mode="br") as f:
-                myar = np.fromfile(file=f, dtype=myd["dtype"])
-                self.y_tr = myar.reshape(myd["shape"])
-        else:
-            self.y_tr = None
-
-        # Outputs, testing.
-        myd = dinfo.y_te
-        if myd:
-            with open(myd["path"], mode="br") as f:
-                myar = np.fromfile(file=f, dtype=myd["dtype"])
-                self.y_te = myar.reshape(myd["shape"])
+    def __init__(self, dinfo, mode="auto", background=False, dtype=None):
+
+        if mode not in ("auto", "mmap", "read"):
+            raise ValueError("Unknown load mode: " + str(mode))
+
+        self.dinfo = dinfo
+        self.mode = mode
+        self.dtype = (None if dtype is None else np.dtype(dtype))
+
+        # Splits which are yet to be opened; see __getattr__. The lock
+        # guards their move from pending to loaded.
+        self._lock = threading.Lock()
+        self._pending = {}
+        for name in self.SPLITS:
+            myd = getattr(dinfo, name)
+            if myd:
+                self._pending[name] = myd
+            else:
+                setattr(self, name, None)
+
+        # Reads already under way, one future per split.
+        self._futures = {}
+        if background:
+            pool = loader(self.LOAD_THREADS)
+            for name, myd in self._pending.items():
+                if name not in self.NO_BACKGROUND:
+                    self._futures[name] = pool.submit(self.load_split, myd)
+
+    def __getattr__(self, name):
+
+        # Only called when normal lookup fails, i.e. for splits which
+        # have not been opened yet. Once opened, the array is stored as
+        # a plain attribute, so subsequent access is free.
+        pending = self.__dict__.get("_pending", {})
+        myd = pending.get(name)
+        if myd is None:
+            # Perhaps just opened by another thread.
+            if name in self.__dict__:
+                return self.__dict__[name]
+            raise AttributeError(name)
+
+        # The split stays pending until it has been read, so a failed
+        # read raises its own error again on the next access. Several
+        # threads may wait on the same read; the first to finish
+        # stores the split, and the others return it.
+        future = self._futures.get(name)
+        if future is not None:
+            myar = future.result() # wait for this split only.
         else:
-            self.y_te = None
+            myar = self.load_split(myd)
+        with self._lock:
+            if name in self.__dict__:
+                return self.__dict__[name]
+            if not isinstance(myar, np.memmap):
+                myar = self.cast(name, myar)
+            setattr(self, name, myar)
+            pending.pop(name, None)
+            self._futures.pop(name, None)
+        return myar
+
+    def cast(self, name, myar):
+        '''
+        A split (or a block of rows of one) converted to the dtype
+        given, if there is one and the split is in CAST.
+        '''
+        if (self.dtype is None or name not in self.CAST
+            or myar.dtype == self.dtype
+            or (self.KEEP_INT and np.issubdtype(myar.dtype, np.integer))):
+            return myar
+        return myar.astype(self.dtype)
+
+    def load_split(self, myd, mode=None):
+        '''
+        Open a single split described by a data info dictionary,
+        either as a read-only memory map or as an in-memory array
+        (or a sparse matrix, made of such arrays). The load mode
+        defaults to that of the object.
+        '''
+        mode = (self.mode if mode is None else mode)
+        if myd.get("format") == "csr":
+            parts = myd["parts"]
+            return sparse.csr_matrix((self.load_split(parts["data"], mode),
+                                      self.load_split(parts["indices"], mode),
+                                      self.load_split(parts["indptr"], mode)),
+                                     shape=tuple(myd["shape"]), copy=False)
+
+        dtype = np.dtype(myd["dtype"])
+        shape = tuple(myd["shape"])
+        nbytes = dtype.itemsize * int(np.prod(shape))
+
+        offset = myd.get("offset", 0)
+
+        if mode == "mmap" or (mode == "auto" and nbytes >= self.MMAP_MIN):
+            return np.memmap(myd["path"], dtype=dtype, mode="r",
+                             offset=offset, shape=shape)
+
+        with open(myd["path"], mode="br") as f:
+            f.seek(offset)
+            myar = np.fromfile(file=f, dtype=dtype, count=int(np.prod(shape)))
+        return myar.reshape(shape)
+
+    def shape_of(self, name):
+        '''
+        Shape of a split, taken from the data info where possible so
+        that the split itself need not be opened.
+        '''
+        if name in self._pending:
+            return tuple(self._pending[name]["shape"])
+        myar = self.__dict__.get(name)
+        return (myar.shape if myar is not None else None)
+
+    def read_rows(self, name, idx):
+        '''
+        Read only the given rows of a split, without opening the
+        whole split. Rows are gathered from a memory map of the
+        underlying file, so the I/O done is proportional to the
+        number of rows requested.
+        '''
+
+        # Input:
+        # name is one of the split names, e.g. "y_tr".
+        # idx is a 1-D array (or list) of row indices.
+
+        # Output:
+        # A (len(idx) x ...) in-memory array holding the rows.
+
+        idx = np.asarray(idx, dtype=np.intp).ravel()
+        if name not in self._pending:
+            myar = getattr(self, name)
+            return self.cast(name, (myar[idx] if sparse.issparse(myar)
+                                    else np.take(myar, idx, 0)))
+
+        myd = self._pending[name]
+        if myd.get("format") == "csr":
+            # Just these rows.
+            return self.cast(name, self.load_split(myd, mode="mmap")[idx])
+        myar = np.memmap(myd["path"], dtype=np.dtype(myd["dtype"]), mode="r",
+                         offset=myd.get("offset", 0), shape=tuple(myd["shape"]))
+        out = np.take(myar, idx, 0)
+        del myar # release the mapping.
+        return self.cast(name, out)
+
+    def batch_index(self, n, size, order="seq", seed=None):
+        '''
+        The row selections (slices) making up one pass over n rows
+        in blocks of the given size.
+
+        order="seq": contiguous blocks, in order.
+        order="shuffle": contiguous blocks, in random order.
+        order="stride": each block takes every nb-th row (nb being
+        the number of blocks), so each is a sample of the whole set.
+        '''
+        nb = max(1, -(-n // size)) # number of blocks.
+        if order == "seq":
+            return [slice(i*size, min(n, (i+1)*size)) for i in range(nb)]
+        if order == "shuffle":
+            perm = np.random.default_rng(seed).permutation(nb)
+            return [slice(i*size, min(n, (i+1)*size)) for i in perm]
+        if order == "stride":
+            return [slice(i, n, nb) for i in range(nb)]
+        raise ValueError("Unknown batch order: " + str(order))
+
+    def batches(self, split="tr", size=1024, order="seq", seed=None,
+                prefetch=True):
+        '''
+        Iterate over a split in (X, y) blocks of (at most) size rows,
+        read from storage one block at a time (see batch_index for
+        the orders available). With prefetch, the next block is read
+        by a background thread while the current one is in use.
+        '''
+        X = getattr(self, "X_" + split)
+        y = getattr(self, "y_" + split)
+        todo = self.batch_index(X.shape[0], size, order=order, seed=seed)
+
+        def read(sl):
+            Xb = X[sl]
+            if not sparse.issparse(Xb):
+                Xb = np.asarray(Xb)
+            yb = (None if y is None else self.cast("y_" + split, np.asarray(y[sl])))
+            return (self.cast("X_" + split, Xb), yb)
+
+        if not prefetch:
+            for sl in todo:
+                yield read(sl)
+            return
+
+        # Double buffering: one block in use, one being read.
+        buf = queue.Queue(maxsize=1)
+        stop = threading.Event()
+
+        def put(item):
+            # Wait for room in the buffer, unless the consumer has gone.
+            while not stop.is_set():
+                try:
+                    buf.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def reader():
+            try:
+                for sl in todo:
+                    if not put(read(sl)):
+                        return
+            except Exception as e:
+                put(e)
+                return
+            put(None)
+
+        thread = threading.Thread(target=reader, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = buf.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
 
     def __str__(self):
 
-        val = (str(self.X_tr.shape) if self.X_tr is not None else str(None))
-        s_Xtr = "X_tr:" + val
-        val = (str(self.X_te.shape) if self.X_te is not None else str(None))
-        s_Xte = "X_te:" + val
-        val = (str(self.y_tr.shape) if self.y_tr is not None else str(None))
-        s_ytr = "y_tr:" + val
-        val = (str(self.y_te.shape) if self.y_te is not None else str(None))
-        s_yte = "y_te:" + val
-        return s_Xtr + "\n" + s_Xte + "\n" + s_ytr + "\n" + s_yte + "\n"
+        out = []
+        for name in self.SPLITS:
+            out.append(name + ":" + str(self.shape_of(name)))
+        return "\n".join(out) + "\n"
 
 
 class Itin:
@@ -0,0 +1,335 @@
+'''
+A single-file, self-describing container for data sets.
+
+Layout of a container file:
+  bytes 0-7   : MAGIC
+  bytes 8-15  : length of the header in bytes (little-endian uint64)
+  header      : UTF-8 JSON, padded with spaces to a multiple of ALIGN
+  payloads    : one per array, each starting at a multiple of ALIGN
+
+The header holds the format version, the model name, any JSON-able
+"misc" entries, and for each array its name, dtype, shape, offset,
+size in bytes, and a CRC-32 checksum of its payload. Arrays held in
+"misc" (e.g. oracle information) are stored as arrays with names of
+the form "misc/<key>".
+
+A split may also be stored as a sparse matrix in CSR form: its
+indptr, indices, and data arrays are stored as arrays named
+"<split>/indptr" and so on, and the header's "sparse" entry gives
+the shape of the matrix. Such splits are opened as scipy.sparse
+matrices (see classes.Data).
+'''
+
+import support.classes as classes
+import json
+import os
+import pickle
+import zlib
+import numpy as np
+from scipy import sparse
+
+MAGIC = b"LMLDATA\x00"
+VERSION = 2 # 2: sparse (CSR) splits.
+ALIGN = 64
+CRC_BLOCK = 2**24 # bytes per block when computing checksums.
+CRC_NONE = "--------" # placeholder, same width as a CRC-32 in hex.
+SPLITS = ("X_tr", "X_te", "y_tr", "y_te")
+CSR_PARTS = ("indptr", "indices", "data")
+
+
+def align(k):
+    '''
+    Round up to the next multiple of ALIGN.
+    '''
+    return (k + ALIGN - 1) // ALIGN * ALIGN
+
+
+def header_bytes(header, size=None):
+    '''
+    Serialize a header, padded with spaces to the given size
+    (by default, just enough for the payloads which follow it
+    to start on an aligned offset).
+    '''
+    b = json.dumps(header, sort_keys=True).encode("utf-8")
+    if size is None:
+        size = align(16 + len(b)) - 16
+    if len(b) > size:
+        raise ValueError("Header does not fit in the space reserved.")
+    return b + b" "*(size - len(b))
+
+
+def split_misc(misc):
+    '''
+    Separate a "misc" dictionary into JSON-able entries and arrays.
+    '''
+    plain = {}
+    arrays = {}
+    for key, val in (misc or {}).items():
+        if isinstance(val, np.ndarray):
+            arrays["misc/" + key] = val
+        elif isinstance(val, np.generic):
+            plain[key] = val.item()
+        else:
+            plain[key] = val
+    json.dumps(plain) # raises TypeError if something cannot be stored.
+    return plain, arrays
+
+
+def csr_arrays(name, X):
+    '''
+    The arrays making up a split stored in CSR form.
+    '''
+    X = sparse.csr_matrix(X)
+    X.sum_duplicates() # canonical form: sorted, unique indices.
+    return {name + "/" + part: getattr(X, part) for part in CSR_PARTS}
+
+
+def create(path, specs, mname=None, misc=None, shapes=None):
+    '''
+    Lay out a new container file, with space for arrays of the
+    given shapes and dtypes, and return writable memory maps of
+    them. Call finalize() once they have been filled.
+    '''
+
+    # Input:
+    # specs is a list of (name, shape, dtype) triples.
+    # misc is a dictionary of JSON-able values (arrays go in specs).
+    # shapes gives the (n x d) shape of each split stored in CSR
+    # form, by name (its parts go in specs; see csr_arrays).
+
+    # Output:
+    # A dictionary of (name: np.memmap) pairs, opened as "r+".
+
+    arrays = []
+    for name, shape, dtype in specs:
+        dtype = np.dtype(dtype)
+        arrays.append({"name": name,
+                       "dtype": dtype.str,
+                       "shape": [int(k) for k in shape],
+                       "offset": 0,
+                       "nbytes": int(np.prod(shape)) * dtype.itemsize,
+                       "crc32": CRC_NONE})
+    header = {"version": VERSION,
+              "mname": mname,
+              "misc": misc or {},
+              "sparse": {name: [int(k) for k in shape]
+                         for name, shape in (shapes or {}).items()},
+              "arrays": arrays}
+
+    # Offsets depend on the header size, and vice versa; grow the
+    # space reserved for the header until everything fits.
+    hlen = 0
+    while True:
+        pos = 16 + hlen
+        for a in arrays:
+            a["offset"] = pos
+            pos = align(pos + a["nbytes"])
+        need = len(header_bytes(header))
+        if need <= hlen:
+            break
+        hlen = need
+
+    with open(path, mode="wb") as f:
+        f.write(MAGIC)
+        f.write(np.uint64(hlen).tobytes())
+        f.write(header_bytes(header, size=hlen))
+        f.truncate(pos)
+
+    buf = np.memmap(path, dtype=np.uint8, mode="r+")
+    return {a["name"]: view(buf, a) for a in arrays}
+
+
+def view(buf, a):
+    '''
+    A view of one array's payload within a byte buffer.
+    '''
+    seg = buf[a["offset"]:(a["offset"]+a["nbytes"])]
+    return seg.view(np.dtype(a["dtype"])).reshape(a["shape"])
+
+
+def read_header(f):
+    '''
+    Read and check the header of an open container file.
+    '''
+    if f.read(8) != MAGIC:
+        raise ValueError("Not a data container (bad magic number).")
+    hlen = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+    header = json.loads(f.read(hlen).decode("utf-8"))
+    if header["version"] > VERSION:
+        raise ValueError("Unsupported container version: "
+                         + str(header["version"]))
+    return header, hlen
+
+
+def checksum(arr):
+    '''
+    CRC-32 of an array's bytes, computed block by block.
+    '''
+    flat = arr.reshape(-1).view(np.uint8)
+    crc = 0
+    for i in range(0, flat.size, CRC_BLOCK):
+        crc = zlib.crc32(flat[i:(i+CRC_BLOCK)], crc)
+    return "%08x" % crc
+
+
+def finalize(path):
+    '''
+    Compute the checksums of all arrays in a container, and
+    record them in its header.
+    '''
+    with open(path, mode="rb") as f:
+        header, hlen = read_header(f)
+    buf = np.memmap(path, dtype=np.uint8, mode="r")
+    for a in header["arrays"]:
+        a["crc32"] = checksum(view(buf, a))
+    del buf
+
+    with open(path, mode="r+b") as f:
+        f.seek(16)
+        f.write(header_bytes(header, size=hlen))
+
+
+def read(path, verify=False):
+    '''
+    Open a container, returning its header and zero-copy,
+    read-only memory-mapped views of all of its arrays. If
+    verify is True, the checksums are checked as well.
+    '''
+    with open(path, mode="rb") as f:
+        header, hlen = read_header(f)
+
+    size = os.path.getsize(path)
+    for a in header["arrays"]:
+        if a["offset"] + a["nbytes"] > size:
+            raise ValueError("Container is truncated: " + path)
+
+    buf = np.memmap(path, dtype=np.uint8, mode="r")
+    arrays = {a["name"]: view(buf, a) for a in header["arrays"]}
+
+    if verify:
+        for a in header["arrays"]:
+            if a["crc32"] != checksum(arrays[a["name"]]):
+                raise ValueError("Checksum mismatch for " + a["name"]
+                                 + " in " + path)
+
+    return header, arrays
+
+
+def write(path, arrays, mname=None, misc=None):
+    '''
+    Write a dictionary of arrays (and misc information) to a
+    new container file. Any scipy.sparse matrices are stored in
+    CSR form.
+    '''
+    plain, misc_arrays = split_misc(misc)
+    todo = {}
+    shapes = {}
+    for name, arr in arrays.items():
+        if sparse.issparse(arr):
+            todo.update(csr_arrays(name, arr))
+            shapes[name] = arr.shape
+        else:
+            todo[name] = arr
+    todo.update(misc_arrays)
+    specs = [(name, arr.shape, arr.dtype) for name, arr in todo.items()]
+    out = create(path, specs, mname=mname, misc=plain, shapes=shapes)
+    for name, arr in todo.items():
+        out[name][...] = arr
+    for arr in out.values():
+        arr.flush()
+    del out
+    finalize(path)
+
+
+def info(path, verify=False):
+    '''
+    Build a data info object pointing into a container file,
+    suitable for use with classes.Data and the models.
+    '''
+    header, arrays = read(path, verify=verify)
+    dinfo = classes.DataInfo()
+    dinfo.mname = header["mname"]
+    dinfo.misc = dict(header["misc"])
+
+    parts = {}
+    for a in header["arrays"]:
+        name = a["name"]
+        myd = {"shape": tuple(a["shape"]),
+               "path": path,
+               "dtype": np.dtype(a["dtype"]).type,
+               "offset": a["offset"]}
+        if name.startswith("misc/"):
+            dinfo.misc[name[5:]] = np.array(arrays[name])
+        elif name in SPLITS:
+            setattr(dinfo, name, myd)
+        elif name.rpartition("/")[0] in SPLITS:
+            parts[name] = myd
+
+    # Splits in CSR form: the shape of the matrix, and its parts.
+    sparse_shapes = header.get("sparse", {})
+    for name, shape in sparse_shapes.items():
+        myd = {part: parts[name + "/" + part] for part in CSR_PARTS}
+        setattr(dinfo, name, {"shape": tuple(shape),
+                              "path": path,
+                              "dtype": myd["data"]["dtype"],
+                              "format": "csr",
+                              "parts": myd})
+
+    for name in SPLITS:
+        if name not in arrays and name not in sparse_shapes:
+            setattr(dinfo, name, None)
+
+    return dinfo
+
+
+def convert(toread, towrite):
+    '''
+    Convert a data set described by a pickled data info object
+    (the older "info.dat" plus raw ".dat" files) into a container.
+    '''
+    with open(toread, mode="br") as f:
+        dinfo = pickle.load(f)
+    data = classes.Data(dinfo, mode="mmap")
+    arrays = {}
+    for name in SPLITS:
+        if getattr(data, name) is not None:
+            arrays[name] = getattr(data, name)
+    write(towrite, arrays, mname=dinfo.mname, misc=dinfo.misc)
+    return info(towrite)
+
+
+def cast(toread, towrite, dtype,
+         names=("X_tr", "X_te", "y_tr", "y_te")):
+    '''
+    Copy a container, storing the given (floating-point) splits in
+    another dtype, e.g. np.float32; for splits in CSR form, only
+    their data part is converted. Arrays are copied a block of
+    CRC_BLOCK bytes at a time, so neither container is read whole.
+    '''
+    header, arrays = read(toread)
+    dtype = np.dtype(dtype)
+
+    def convert_to(name, arr):
+        split, sep, part = name.rpartition("/")
+        if not (name in names or (split in names and part == "data")):
+            return arr.dtype
+        if np.issubdtype(arr.dtype, np.floating):
+            return dtype
+        return arr.dtype
+
+    specs = [(name, arr.shape, convert_to(name, arr))
+             for name, arr in arrays.items()]
+    shapes = {name: tuple(shape)
+              for name, shape in header.get("sparse", {}).items()}
+    out = create(towrite, specs, mname=header["mname"], misc=header["misc"],
+                 shapes=shapes)
+    for name, arr in arrays.items():
+        flat_in = arr.reshape(-1)
+        flat_out = out[name].reshape(-1)
+        step = max(1, CRC_BLOCK // max(1, arr.itemsize))
+        for i in range(0, flat_in.size, step):
+            flat_out[i:(i+step)] = flat_in[i:(i+step)]
+        out[name].flush()
+    del out, arrays
+    finalize(towrite)
+    return info(towrite)
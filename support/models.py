@@ -2,26 +2,185 @@
 import support.classes as classes
 import numpy as np
 import scipy
+from scipy import sparse
 from scipy import stats
 
+# Rows per partial product when accumulating in float64 (see tdot).
+SUM_ROWS = 4096
+
+# Most elements in the intermediate arrays of one block of a batched
+# loss evaluation (see l_batch_imp); larger problems go in chunks.
+BATCH_ELEMS = 2**18
+
+
+def chunks(m, per_item):
+    '''
+    Slices over m items (rows or columns), each chunk taking at
+    most BATCH_ELEMS elements when each item needs per_item of them.
+    '''
+    size = max(1, BATCH_ELEMS // max(1, per_item))
+    return [slice(i, min(i+size, m)) for i in range(0, m, size)]
+
+
+def is_int(X):
+    return np.issubdtype(X.dtype, np.integer)
+
+
+def mdot(X, W):
+    '''
+    The product XW, for X either an array or a scipy.sparse matrix
+    (in which case the cost goes with the number of non-zeros).
+    '''
+    if sparse.issparse(X):
+        return np.asarray(X @ W)
+    return np.dot(X, W)
+
+
+def dense(X):
+    '''
+    X as an array, if it is a scipy.sparse matrix.
+    '''
+    return (X.toarray() if sparse.issparse(X) else X)
+
+
+def tdot(A, B):
+    '''
+    The product A'B, as a float64 array. For single-precision
+    inputs, each block of SUM_ROWS rows is multiplied in the
+    inputs' own precision, and the blocks are summed in float64.
+    Integer inputs are converted to float64 one block of rows at
+    a time (see chunks), never as a whole. Sparse inputs (scipy.sparse)
+    are multiplied as they are, after converting their non-zeros.
+    '''
+    if sparse.issparse(A) or sparse.issparse(B):
+        out = (A.astype(np.float64, copy=False).T
+               @ B.astype(np.float64, copy=False))
+        return np.asarray(dense(out))
+    if is_int(A) or is_int(B):
+        out = np.zeros( (A.shape[1],B.shape[1]), dtype=np.float64)
+        for rows in chunks(A.shape[0], A.shape[1]+B.shape[1]):
+            out += np.dot(np.transpose(A[rows]).astype(np.float64),
+                          B[rows].astype(np.float64))
+        return out
+    if np.result_type(A, B) == np.float64 or A.shape[0] <= SUM_ROWS:
+        return np.dot(np.transpose(A), B).astype(np.float64, copy=False)
+    out = np.zeros( (A.shape[1],B.shape[1]), dtype=np.float64)
+    for i in range(0, A.shape[0], SUM_ROWS):
+        out += np.dot(np.transpose(A[i:(i+SUM_ROWS)]), B[i:(i+SUM_ROWS)])
+    return out
+
+
+def xdot(W, X):
+    '''
+    The product WX', in the precision of W. When X is of integer
+    type, its rows are converted one block at a time (see chunks).
+    '''
+    if sparse.issparse(X):
+        return np.transpose(np.asarray(X @ np.transpose(W))).astype(W.dtype, copy=False)
+    if not is_int(X):
+        return np.dot(W, np.transpose(X))
+    out = np.empty( (W.shape[0],X.shape[0]), dtype=W.dtype)
+    for rows in chunks(X.shape[0], X.shape[1]):
+        out[:,rows] = np.dot(W, np.transpose(X[rows]).astype(W.dtype))
+    return out
+
+
+def gram_stats(cache, X, y):
+    '''
+    Sufficient statistics of least squares on (X,y): X'X, X'y
+    and y'y (in float64), along with the number of points. They
+    are kept in the cache dictionary given, along with the arrays
+    they came from, and each is recomputed only when X or y is no
+    longer the same array (e.g. a new voxel's responses).
+    '''
+    if cache.get("X") is not X:
+        cache.clear()
+        cache["X"] = X
+        cache["n"] = X.shape[0]
+        cache["XtX"] = tdot(X, X)
+    if cache.get("y") is not y:
+        cache["y"] = y
+        cache["Xty"] = tdot(X, np.reshape(y, (X.shape[0],-1)))
+        cache["yty"] = float(np.dot(np.ravel(y), np.ravel(y).astype(np.float64)))
+    return cache
+
+
+def corr_cols(A, B):
+    '''
+    Pearson's correlation between matching columns of A and B,
+    taken to be zero where either column is constant.
+    '''
+    A = A - np.mean(A, axis=0)
+    B = B - np.mean(B, axis=0)
+    num = np.einsum("ij,ij->j", A, B)
+    den = np.sqrt(np.einsum("ij,ij->j", A, A) * np.einsum("ij,ij->j", B, B))
+    return np.where(den > 0, num / np.where(den > 0, den, 1), 0)
+
+
+def moments(blocks):
+    '''
+    Mean and standard deviation of values which arrive in blocks
+    (e.g. per-batch losses), without keeping the blocks around.
+    Blocks are merged using the pairwise update of Chan et al.
+    '''
+    k = 0
+    mean = 0.0
+    m2 = 0.0
+    for v in blocks:
+        v = np.asarray(v, dtype=np.float64)
+        kb = v.size
+        if kb == 0:
+            continue
+        mb = v.mean()
+        delta = mb - mean
+        m2 += np.sum((v-mb)**2) + delta**2 * k * kb / (k+kb)
+        mean += delta * kb / (k+kb)
+        k += kb
+    return mean, np.sqrt(m2/k)
+
+
 class LgstReg(classes.Data):
 
-    def __init__(self, dinfo):
+    # Integer inputs (e.g. uint8 pixels) are kept as stored.
+    KEEP_INT = True
+
+    def __init__(self, dinfo, mode="auto", background=False, dtype=None):
         '''
         Given data with X_tr, X_te, y_tr, y_te, we
         initialize a model object with loss functions, gradients,
         Hessians, etc., as well as an "eval" method which
         automatically knows to use the test data.
+
+        With dtype=np.float32, the inputs are converted as they are
+        opened, and weights, activations and gradients are all kept
+        in single precision; only sums over data points are
+        accumulated in float64. The default is float64 throughout.
+        Memory-mapped inputs are only converted block by block, so
+        computations over the whole split keep the stored precision,
+        unless the data were prepared in float32 (see classes.Data).
+
+        Inputs stored as integers (e.g. the uint8 pixels of MNIST)
+        are never converted as a whole. The model sees them as
+        x_scale * X + x_offset (from dinfo.misc; by default 1 and 0),
+        with the scale and offset folded into the weights for the
+        activations, and into the sums over points for the gradients
+        (see xmul and xtmul).
         '''
         # Given data info, load up the (X,y) data.
-        super(LgstReg,self).__init__(dinfo)
-
-        # Convert original labels to a one-hot binary representation.
+        super(LgstReg,self).__init__(dinfo, mode=mode,
+                                     background=background, dtype=dtype)
+        self.ftype = np.dtype(np.float64 if dtype is None else dtype)
+        self.x_scale = float(dinfo.misc.get("x_scale", 1.0))
+        self.x_offset = float(dinfo.misc.get("x_offset", 0.0))
+
+        # Keep the labels as flat integer class indices; a one-hot
+        # representation (C_tr/C_te) is only built if asked for.
         self.nc = self.get_nc() # get the number of classes.
-        self.C_tr = self.onehot(y=self.y_tr) # one-hot training labels.
-        self.C_te = self.onehot(y=self.y_te) # one-hot testing labels.
-        self.n = self.X_tr.shape[0] # number of training obs.
-        self.d_feat = self.X_tr.shape[1] # number of features.
+        self.c_tr = self.labels(y=self.y_tr) # training labels.
+        self.c_te = self.labels(y=self.y_te) # testing labels.
+        self._onehot = {}
+        self._forward = None # last activations computed on a split.
+        self.n, self.d_feat = self.shape_of("X_tr") # training obs/features.
         self.d_para = self.d_feat * (self.nc-1) # number of parameters to set.
         
         
@@ -36,7 +195,7 @@ class LgstReg(classes.Data):
 
         # Randomly generated (uniformly on [-1,1].
         out = 2 * np.random.random_sample( (self.d_para,1) ) - 1
-        return out
+        return out.astype(self.ftype)
 
     
     def get_nc(self):
@@ -46,6 +205,13 @@ class LgstReg(classes.Data):
         return np.unique(np.concatenate( (self.y_tr, self.y_te), axis=0)).size
 
     
+    def labels(self, y):
+        '''
+        Labels as a flat vector of integer class indices.
+        '''
+        return np.asarray(y).ravel().astype(np.intp)
+
+    
     def onehot(self, y):
         '''
         A function for encoding y into a one-hot vector.
@@ -56,23 +222,43 @@ class LgstReg(classes.Data):
         # NOTE: we say "k" here because it may be the training,
         #       test, or both training/test labels together.
 
-        nc = self.nc
-        k = y.size
-        C = np.zeros(nc*k, dtype=np.int16).reshape( (k,nc) )
-
-        for i in range(k):
-            print("y:", y)
-            j = y[i,0] # assumes y has only one column.
-            C[i,j] = 1
+        c = self.labels(y=y)
+        k = c.size
+        C = np.zeros(k*self.nc, dtype=np.int16).reshape( (k,self.nc) )
+        C[np.arange(k),c] = 1
 
         return C
 
+    @property
+    def C_tr(self):
+        # One-hot training labels, built on first use.
+        if "tr" not in self._onehot:
+            self._onehot["tr"] = self.onehot(y=self.c_tr)
+        return self._onehot["tr"]
+
+    @property
+    def C_te(self):
+        # One-hot testing labels, built on first use.
+        if "te" not in self._onehot:
+            self._onehot["te"] = self.onehot(y=self.c_te)
+        return self._onehot["te"]
+
     
-    def eval(self, w):
+    def eval(self, w, size=None):
         '''
-        Evaluate a parameter vector on the test data.
+        Evaluate a parameter vector on the test data. If size is
+        given, the test data is read in blocks of that many rows.
         '''
 
+        if size is not None:
+            num_correct = [0]
+            def losses():
+                for X, y in self.batches(split="te", size=size):
+                    num_correct[0] += (self.classify(w=w, X=X) == y).sum()
+                    yield self.l_imp(w=w, X=X, c=y)
+            mean, std = moments(losses())
+            return [mean, std, num_correct[0] / self.y_te.shape[0]]
+
         losses = self.l_te(w=w) # logistic reg loss.
 
         # Based on pre-specified decision rule, get classification rate.
@@ -80,7 +266,8 @@ class LgstReg(classes.Data):
         perf = self.class_perf(y_est, self.y_te)
         
         # Specify the loss-based statistics to use here.
-        rawres = [losses.mean(), losses.std(), perf["rate"]]
+        rawres = [losses.mean(dtype=np.float64), losses.std(dtype=np.float64),
+                  perf["rate"]]
         # potential extension: can add per-class P/R/F1 if desired.
         
         return rawres
@@ -145,7 +332,121 @@ class LgstReg(classes.Data):
                 "PRF1": prec_rec}
 
 
-    def l_imp(self, w, X, C, lam=0):
+    def xfloat(self, X):
+        '''
+        Inputs as the model sees them (x_scale * X + x_offset), as
+        a float array; only for small blocks of rows.
+        '''
+        X = dense(X)
+        if self.x_scale == 1 and self.x_offset == 0 and not is_int(X):
+            return X
+        out = np.asarray(X, dtype=self.ftype) * self.ftype.type(self.x_scale)
+        if self.x_offset != 0:
+            out += self.ftype.type(self.x_offset)
+        return out
+
+    def xmul(self, W, X):
+        '''
+        The product W(x_scale * X + x_offset)', for a (m x d_feat)
+        matrix W; the scale and offset are applied to W, not X.
+        '''
+        if self.x_scale == 1:
+            out = xdot(W, X)
+        else:
+            out = xdot(W * self.ftype.type(self.x_scale), X)
+        if self.x_offset != 0:
+            out += self.x_offset * np.sum(W, axis=1, keepdims=True)
+        return out
+
+    def xtmul(self, P, X):
+        '''
+        The product P(x_scale * X + x_offset), for a (m x k) matrix
+        P, as a float64 array (see tdot); the scale and offset are
+        applied to the (m x d_feat) result.
+        '''
+        out = tdot(np.transpose(P), X)
+        if self.x_scale != 1:
+            out *= self.x_scale
+        if self.x_offset != 0:
+            out += self.x_offset * np.sum(P, axis=1, keepdims=True, dtype=np.float64)
+        return out
+
+
+    def activations(self, w, X):
+        '''
+        Activations of k observations, and their log-normalizers
+        (log-sum-exp over the classes), computed stably by first
+        subtracting the largest activation of each observation.
+        '''
+
+        # Output:
+        # A is a (nc x k) matrix; the last row (reference class) is zero.
+        # logZ is a vector of length k.
+
+        k = X.shape[0]
+        A = np.zeros(k*self.nc, dtype=self.ftype).reshape( (self.nc, k) )
+        A[:-1,:] = self.xmul(w.reshape((self.nc-1,self.d_feat)), # reshape w.
+                             X) # leave last row as zeros.
+        amax = A.max(axis=0)
+        logZ = amax + np.log(np.sum(np.exp(A-amax), axis=0))
+        return A, logZ
+
+    
+    def forward(self, w, X):
+        '''
+        As activations(), but when X is one of the loaded splits,
+        the result is kept, and reused for as long as the same
+        split is evaluated at the same weights.
+        '''
+        last = self._forward
+        if (last is not None and last[0] is X and last[1].shape == w.shape
+            and np.array_equal(last[1], w)):
+            return last[2], last[3]
+
+        A, logZ = self.activations(w=w, X=X)
+        if any(X is self.__dict__.get(name) for name in ("X_tr", "X_te")):
+            self._forward = (X, np.array(w), A, logZ)
+        return A, logZ
+
+    
+    def probs(self, w, X):
+        '''
+        Conditional label probabilities (nc x k), as a new array.
+        '''
+        A, logZ = self.forward(w=w, X=X)
+        return np.exp(A-logZ)
+
+    
+    def loss_and_grad(self, w, split="tr", lam=0):
+        '''
+        Losses and mean gradient on a split, from a single pass
+        over the activations (shared with eval and classify).
+        '''
+
+        # Output:
+        # The per-point losses (as from l_tr/l_te), and the mean
+        # gradient (as from g_mean_tr/g_mean_te), as a pair.
+
+        X = getattr(self, "X_"+split)
+        c = getattr(self, "c_"+split)
+        k = X.shape[0]
+
+        A, logZ = self.forward(w=w, X=X)
+        err = logZ - A[c,np.arange(k)]
+
+        P = np.exp(A-logZ)
+        P[c,np.arange(k)] -= 1
+        g = (self.xtmul(P[:-1,:], X).reshape( (1,self.d_para) )
+             / k).astype(self.ftype)
+
+        if (lam > 0):
+            return (err + lam * np.linalg.norm(w)**2,
+                    g + 2 * lam * w.transpose())
+        else:
+            return err, g
+
+
+    def l_imp(self, w, X, c, lam=0):
         '''
         Implementation of the multi-class logistic regression
         loss function.
@@ -154,8 +455,7 @@ class LgstReg(classes.Data):
         # Input:
         # w is a (d_para x 1) matrix of weights.
         # X is a (k x d_feat) matrix of k observations.
-        # C is a (k x nc) matrix giving a binarized encoding of the
-        # class labels for each observation; each row a one-hot vector.
+        # c holds the k class labels, in {0,...,nc-1} (any shape).
         # lam is a non-negative regularization parameter.
         # NOTE: k can be anything, the training/test sample size.
 
@@ -163,32 +463,92 @@ class LgstReg(classes.Data):
         # A vector of length k with losses evaluated at k points.
 
         k = X.shape[0]
+        c = self.labels(y=c)
 
-        # Initialize and populate the activations.
-        A = np.zeros(k*self.nc).reshape( (self.nc, k) )
-        A[:-1,:] = np.dot(w.reshape((self.nc-1,self.d_feat)), # reshape w.
-                          np.transpose(X)) # leave last row as zeros.
+        # Activations and their log-normalizers.
+        A, logZ = self.forward(w=w, X=X)
 
         # Raw activations of all the correct weights.
-        cvec = np.sum(A*np.transpose(C), axis=0)
+        cvec = A[c,np.arange(k)]
         
         # Compute the negative log-likelihoods.
-        err = np.log(np.sum(np.exp(A), axis=0)) - cvec
+        err = logZ - cvec
 
         # Return the losses (all data points), with penalty if needed.
         if (lam > 0):
-            return err + lam * np.linalg.norm(W)**2
+            return err + lam * np.linalg.norm(w)**2
         else:
             return err
         
     def l_tr(self, w, lam=0):
-        return self.l_imp(w=w, X=self.X_tr, C=self.C_tr, lam=lam)
+        return self.l_imp(w=w, X=self.X_tr, c=self.c_tr, lam=lam)
 
     def l_te(self, w, lam=0):
-        return self.l_imp(w=w, X=self.X_te, C=self.C_te, lam=lam)
+        return self.l_imp(w=w, X=self.X_te, c=self.c_te, lam=lam)
+
+    def l_batch_imp(self, W, X, c, lam=0):
+        '''
+        Mean loss over k points, for each of m weight vectors,
+        with the activations for many of them at once coming
+        from a single matrix product.
+        '''
+
+        # Input:
+        # W is a (d_para x m) matrix, one weight vector per column.
+        # X, c, lam are as in l_imp.
+
+        # Output:
+        # A vector of length m, the mean losses.
+
+        k = X.shape[0]
+        c = self.labels(y=c)
+        m = W.shape[1]
+        out = np.zeros(m, dtype=np.float64)
+
+        # Arrange the weights as (d_feat x (nc-1)*m), so that each
+        # block of rows of X needs just one matrix product.
+        W2 = np.transpose(W.reshape( (self.nc-1,self.d_feat,m) ),
+                          (1,0,2)).reshape( (self.d_feat,-1) )
+
+        for rows in chunks(k, W2.shape[1]):
+            kb = rows.stop - rows.start
+            cb = c[rows]
+            A = np.transpose(self.xmul(np.transpose(W2), X[rows]))
+            A = A.reshape( (kb,self.nc-1,m) )
+
+            # Stable log-sum-exp, with the last class's zero activation.
+            amax = np.maximum(A.max(axis=1), 0) # (kb x m)
+            Z = np.exp(-amax) + np.sum(np.exp(A-amax[:,np.newaxis,:]), axis=1)
+
+            # Activations of the correct classes (zero for the last).
+            cvec = A[np.arange(kb),np.minimum(cb,self.nc-2),:]
+            cvec[cb == self.nc-1,:] = 0
+            out += np.sum(amax + np.log(Z) - cvec, axis=0)
+
+        out /= k
+
+        if (lam > 0):
+            return out + lam * np.sum(W*W, axis=0)
+        else:
+            return out
+
+    def l_tr_batch(self, W, lam=0):
+        return self.l_batch_imp(W=W, X=self.X_tr, c=self.c_tr, lam=lam)
+
+    def l_te_batch(self, W, lam=0):
+        return self.l_batch_imp(W=W, X=self.X_te, c=self.c_te, lam=lam)
+
+    def l_stream(self, w, split="tr", size=1024, order="seq", lam=0):
+        '''
+        Mean and standard deviation of the losses on a split, read
+        in blocks of size rows (see classes.Data.batches).
+        '''
+        return moments(self.l_imp(w=w, X=X, c=y, lam=lam)
+                       for X, y in self.batches(split=split, size=size,
+                                                order=order))
     
     
-    def g_imp(self, w, X, C, lam=0):
+    def g_imp(self, w, X, c, lam=0):
         '''
         Implementation of the gradient of the loss function used in
         multi-class logistic regression.
@@ -197,49 +557,127 @@ class LgstReg(classes.Data):
         # Input:
         # w is a (d_para x 1) matrix of weights.
         # X is a (k x d_feat) matrix of k observations.
-        # C is a (k x nc) matrix giving a binarized encoding of the
-        # class labels for each observation; each row a one-hot vector.
+        # c holds the k class labels, in {0,...,nc-1} (any shape).
         # lam is a non-negative regularization parameter.
         # NOTE: k can be anything, the training/test sample size.
 
         # Output:
         # A (k x d_para) matrix of gradients eval'd at k points.
 
-        # Initialize and populate the activations.
         k = X.shape[0]
-        
-        A = np.zeros(k*self.nc).reshape( (self.nc,k) )
-        A[:-1,:] = np.dot(w.reshape((self.nc-1,self.d_feat)), # reshape w.
-                          np.transpose(X)) # leave last row as zeros.
+        c = self.labels(y=c)
 
-        # Compute the conditional label probabilities.
-        P = np.exp(A) / np.sum(np.exp(A), axis=0) # (nc x k)
-        
-        # Initialize a large matrix (k x d_para) to house per-point grads.
-        G = np.arange(k*self.d_para).reshape( (k,self.d_para) )
+        # Compute the conditional label probabilities, less the
+        # one-hot labels (subtracting one at each correct class).
+        P = self.probs(w=w, X=X) # (nc x k)
+        P[c,np.arange(k)] -= 1
 
-        for i in range(k):
-            # A very tall vector (i.e., just one "axis").
-            G[i,:] = np.kron(a=(P[:-1,i]-C[i,:-1]), b=X[i,:])
-            # NOTE: carefully removing the last elements.
+        # Row i is kron(P[:-1,i], X[i,:]), all rows at once.
+        # NOTE: carefully removing the last class.
+        G = (np.transpose(P[:-1,:])[:,:,np.newaxis]
+             * self.xfloat(X)[:,np.newaxis,:]).reshape( (k,self.d_para) )
 
-        return G
+        if (lam > 0):
+            return G + 2 * lam * w.transpose()
+        else:
+            return G
         
     def g_tr(self, w, lam=0):
-        return self.g_imp(w=w, X=self.X_tr, C=self.C_tr, lam=lam)
+        return self.g_imp(w=w, X=self.X_tr, c=self.c_tr, lam=lam)
 
     def g_te(self, w, lam=0):
-        return self.g_imp(w=w, X=self.X_te, C=self.C_te, lam=lam)
+        return self.g_imp(w=w, X=self.X_te, c=self.c_te, lam=lam)
+
+    def g_mean_imp(self, w, X, c, lam=0):
+        '''
+        Mean of the per-point gradients given by g_imp, computed
+        as a single matrix product, without forming them.
+        '''
+
+        # Input: as in g_imp.
+
+        # Output:
+        # A (1 x d_para) matrix, the mean over the k points.
+
+        k = X.shape[0]
+        c = self.labels(y=c)
+
+        P = self.probs(w=w, X=X) # (nc x k)
+        P[c,np.arange(k)] -= 1
+
+        # (nc-1 x k) times (k x d_feat), flattened as in g_imp.
+        g = (self.xtmul(P[:-1,:], X).reshape( (1,self.d_para) )
+             / k).astype(self.ftype)
+
+        if (lam > 0):
+            return g + 2 * lam * w.transpose()
+        else:
+            return g
+
+    def g_mean_tr(self, w, lam=0):
+        return self.g_mean_imp(w=w, X=self.X_tr, c=self.c_tr, lam=lam)
+
+    def g_mean_te(self, w, lam=0):
+        return self.g_mean_imp(w=w, X=self.X_te, c=self.c_te, lam=lam)
+
+    def g_mean_batch(self, w, idx, split="tr", lam=0):
+        '''
+        Mean gradient over a mini-batch, given by an array of
+        row indices into one of the splits.
+        '''
+        c = getattr(self, "c_"+split)
+        return self.g_mean_imp(w=w, X=getattr(self, "X_"+split)[idx],
+                               c=c[idx], lam=lam)
+
+    def g_stream(self, w, split="tr", size=1024, order="seq", lam=0):
+        '''
+        Mean of the per-point gradients on a split, read in blocks
+        of size rows. Output is a (1 x d_para) matrix.
+        '''
+        k = 0
+        gsum = np.zeros((1,self.d_para), dtype=np.float64)
+        for X, y in self.batches(split=split, size=size, order=order):
+            gsum += X.shape[0] * self.g_mean_imp(w=w, X=X, c=y, lam=lam)
+            k += X.shape[0]
+        return gsum / k
 
     
-    def h_imp(self, w, lam=0):
-        pass
+    def h_imp(self, w, v, X, lam=0):
+        '''
+        Product of the Hessian of the mean loss over k points
+        with a vector, computed from the label probabilities
+        without forming the (d_para x d_para) Hessian.
+        '''
+
+        # Input:
+        # w is a (d_para x 1) matrix of weights.
+        # v is a (d_para x 1) matrix, the direction.
+        # X is a (k x d_feat) matrix of k observations.
+        # lam is a non-negative regularization parameter.
+
+        # Output:
+        # A (d_para x 1) matrix, the Hessian at w times v.
+
+        # Per point, the Hessian is (diag(p)-pp') kron xx', with p
+        # the probabilities of all but the last class.
+        k = X.shape[0]
+        P = self.probs(w=w, X=X)[:-1,:] # (nc-1 x k)
+        U = self.xmul(v.reshape((self.nc-1,self.d_feat)), X) # (nc-1 x k)
+        PU = P * U
+        S = PU - P * np.sum(PU, axis=0)
+        hv = (self.xtmul(S, X).reshape( (self.d_para,1) )
+              / k).astype(self.ftype)
+
+        if (lam > 0):
+            return hv + 2 * lam * v
+        else:
+            return hv
     
-    def h_tr(self, w, lam=0):
-        pass
+    def h_tr(self, w, v, lam=0):
+        return self.h_imp(w=w, v=v, X=self.X_tr, lam=lam)
 
-    def h_te(self, w, lam=0):
-        pass
+    def h_te(self, w, v, lam=0):
+        return self.h_imp(w=w, v=v, X=self.X_te, lam=lam)
 
     def classify(self, w, X):
         '''
@@ -255,30 +693,120 @@ class LgstReg(classes.Data):
         # Output:
         # A vector of length k, housing labels in {0,...,nc-1}.
 
-        # Get the activations, and then the conditional probabilities.
+        # The largest activation has the largest probability.
         k = X.shape[0]
-        A = np.zeros(k*self.nc).reshape( (self.nc,k) )
-        A[:-1,:] = np.dot(w.reshape((self.nc-1,self.d_feat)), # reshape w.
-                          np.transpose(X)) # leave last row as zeros.
-        P = np.exp(A) / np.sum(np.exp(A), axis=0) # (nc x k)
+        A, logZ = self.forward(w=w, X=X)
 
         # Return the class with the largest prob, given the data.
-        return np.argmax(P, axis=0).reshape( (k,1) )
+        return np.argmax(A, axis=0).reshape( (k,1) )
 
 
-class LinReg(classes.Data):
+class GramMixin:
+    '''
+    Losses and gradients of least squares on whole splits, from the
+    cached sufficient statistics X'X, X'y and y'y (see gram_stats),
+    shared by LinReg and NoisyOpt. Used in place of the per-point
+    methods when gram_mode is set. LOSS_SCALE multiplies the squared
+    errors, as in the class's l_imp.
+    '''
+
+    LOSS_SCALE = 1
+
+    def gram(self, split="tr"):
+        '''
+        Cached X'X, X'y and y'y for a split (see gram_stats).
+        '''
+        return gram_stats(self._gram.setdefault(split, {}),
+                          getattr(self, "X_"+split),
+                          getattr(self, "y_"+split))
+
+    def l_mean_gram(self, w, split="tr", lam_l1=0, lam_l2=0):
+        '''
+        Mean of the losses given by l_imp, from the cached X'X,
+        X'y and y'y of a split, in O(d^2).
+        '''
+        S = self.gram(split)
+        w = w.reshape( (-1,1) )
+        sse = (np.dot(w.transpose(), np.dot(S["XtX"],w))
+               - 2*np.dot(w.transpose(), S["Xty"]))[0,0] + S["yty"]
+        out = self.LOSS_SCALE * sse / S["n"]
+        if lam_l1 > 0:
+            out += lam_l1 * np.sum(np.abs(w)) # l1 norm
+        if lam_l2 > 0:
+            out += lam_l2 * np.sum(w*w) # squared l2
+        return out
 
-    def __init__(self, dinfo):
+    def g_mean_gram(self, w, split="tr", lam_l1=0, lam_l2=0):
+        '''
+        As g_mean_imp, from the cached statistics of a split.
+        '''
+        S = self.gram(split)
+        g = ((np.dot(S["XtX"],w) - S["Xty"]).transpose()
+             / S["n"]).astype(self.ftype)
+        if lam_l1 > 0:
+            g = g + lam_l1 * (np.sign(w)).transpose()
+        if lam_l2 > 0:
+            g = g + 2 * lam_l2 * w.transpose()
+        return g
+
+    def g_j_mean_gram(self, j, w, split="tr", lam_l1=0, lam_l2=0):
+        '''
+        Mean of the per-point coordinate gradients given by
+        g_j_imp, from the cached statistics of a split, in O(d).
+        '''
+        S = self.gram(split)
+        g_j = (np.dot(S["XtX"][j,:], w)[0] - S["Xty"][j,0]) / S["n"]
+        if lam_l1 > 0:
+            g_j += lam_l1 * np.sign(w[j,0])
+        if lam_l2 > 0:
+            g_j += 2 * lam_l2 * w[j,0]
+        return g_j
+
+    def l_mean_tr(self, w, lam_l1=0, lam_l2=0):
+        if self.gram_mode:
+            return self.l_mean_gram(w=w, split="tr",
+                                    lam_l1=lam_l1, lam_l2=lam_l2)
+        return np.mean(self.l_tr(w=w, lam_l1=lam_l1, lam_l2=lam_l2))
+
+    def g_j_mean_tr(self, j, w, lam_l1=0, lam_l2=0):
+        if self.gram_mode:
+            return self.g_j_mean_gram(j=j, w=w, split="tr",
+                                      lam_l1=lam_l1, lam_l2=lam_l2)
+        return np.mean(self.g_j_tr(j=j, w=w, lam_l1=lam_l1, lam_l2=lam_l2))
+
+
+class LinReg(GramMixin, classes.Data):
+
+    # Inputs and responses both follow the dtype policy.
+    CAST = ("X_tr", "X_te", "y_tr", "y_te")
+
+    def __init__(self, dinfo, mode="auto", background=False, dtype=None):
         '''
         Given data with X_tr, X_te, y_tr, y_te, we
         initialize a model object with loss functions, gradients,
         Hessians, etc., as well as an "eval" method which
         automatically knows to use the test data.
+
+        With dtype=np.float32, the data are converted as they are
+        opened, and weights, predictions and gradients are kept in
+        single precision, with sums over data points accumulated in
+        float64. The default is float64 throughout. Memory-mapped
+        data are only converted block by block, so computations over
+        the whole split (the Gram matrix, the ridge solution) keep the
+        stored precision, unless the data were prepared in float32
+        (see classes.Data).
         '''
         # Given data info, load it up into memory for use.
-        super(LinReg,self).__init__(dinfo)
-        self.n = self.X_tr.shape[0]
-        self.d = self.X_tr.shape[1]
+        super(LinReg,self).__init__(dinfo, mode=mode,
+                                    background=background, dtype=dtype)
+        self.ftype = np.dtype(np.float64 if dtype is None else dtype)
+        self.n, self.d = self.shape_of("X_tr")
+
+        # Optionally, losses and gradients on whole splits can come
+        # from X'X, X'y and y'y, computed once (see gram()).
+        self.gram_mode = False
+        self._gram = {}
+        self._ridge = {} # see ridge_factor().
 
 
     def __str__(self):
@@ -292,18 +820,22 @@ class LinReg(classes.Data):
 
         # Randomly generated uniformly on [-1,1].
         out = 2 * np.random.random_sample((self.d,1)) - 1
-        return out
+        return out.astype(self.ftype)
     
 
-    def eval(self, w):
+    def eval(self, w, size=None):
         '''
-        Evaluate a parameter vector on the test data.
+        Evaluate a parameter vector on the test data. If size is
+        given, the test data is read in blocks of that many rows.
         '''
+        if size is not None:
+            return list(self.l_stream(w=w, split="te", size=size))
+
         # Specify the loss to use here.
         losses = self.l_te(w=w)
 
         # Specify the loss-based statistics to use here.
-        rawres = [losses.mean(), losses.std()]
+        rawres = [losses.mean(dtype=np.float64), losses.std(dtype=np.float64)]
         
         return rawres
 
@@ -332,7 +864,7 @@ class LinReg(classes.Data):
         else:
             l2reg = 0
 
-        return (np.dot(X,w)-y)**2 + l1reg + l2reg
+        return (mdot(X,w)-y)**2 + l1reg + l2reg
 
     
     def l_tr(self, w, lam_l1=0, lam_l2=0):
@@ -342,6 +874,51 @@ class LinReg(classes.Data):
     def l_te(self, w, lam_l1=0, lam_l2=0):
         return self.l_imp(w=w, X=self.X_te, y=self.y_te,
                           lam_l1=lam_l1, lam_l2=lam_l2)
+
+    def l_batch_imp(self, W, X, y, lam_l1=0, lam_l2=0):
+        '''
+        Mean loss over k points, for each of m weight vectors,
+        with the predictions for many of them at once coming
+        from a single matrix product.
+        '''
+        # Args:
+        # W is a (d x m) matrix, one weight vector per column.
+        # X, y, lam_* are as in l_imp.
+
+        # Output: vector of length m, the mean losses.
+
+        k = X.shape[0]
+        m = W.shape[1]
+        out = np.zeros(m, dtype=np.float64)
+        for cols in chunks(m, k):
+            out[cols] = np.mean((mdot(X,W[:,cols])-y)**2, axis=0)
+
+        # Compute regularization terms if required.
+        if lam_l1 > 0:
+            out += lam_l1 * np.sum(np.abs(W), axis=0) # l1 norms
+        if lam_l2 > 0:
+            out += lam_l2 * np.sum(W*W, axis=0) # squared l2
+
+        return out
+
+    def l_tr_batch(self, W, lam_l1=0, lam_l2=0):
+        return self.l_batch_imp(W=W, X=self.X_tr, y=self.y_tr,
+                                lam_l1=lam_l1, lam_l2=lam_l2)
+
+    def l_te_batch(self, W, lam_l1=0, lam_l2=0):
+        return self.l_batch_imp(W=W, X=self.X_te, y=self.y_te,
+                                lam_l1=lam_l1, lam_l2=lam_l2)
+
+    def l_stream(self, w, split="tr", size=1024, order="seq",
+                 lam_l1=0, lam_l2=0):
+        '''
+        Mean and standard deviation of the losses on a split, read
+        in blocks of size rows (see classes.Data.batches).
+        '''
+        return moments(self.l_imp(w=w, X=X, y=y,
+                                  lam_l1=lam_l1, lam_l2=lam_l2)
+                       for X, y in self.batches(split=split, size=size,
+                                                order=order))
     
     
     def g_imp(self, w, X, y, lam_l1=0, lam_l2=0):
@@ -367,7 +944,7 @@ class LinReg(classes.Data):
         else:
             g_l2reg = 0
 
-        return -(y-np.dot(X,w)) * X + g_l1reg + g_l2reg
+        return -(y-mdot(X,w)) * dense(X) + g_l1reg + g_l2reg
 
     def g_tr(self, w, lam_l1=0, lam_l2=0):
         return self.g_imp(w=w, X=self.X_tr, y=self.y_tr,
@@ -377,6 +954,67 @@ class LinReg(classes.Data):
         return self.g_imp(w=w, X=self.X_te, y=self.y_te,
                           lam_l1=lam_l1, lam_l2=lam_l2)
 
+    def g_mean_imp(self, w, X, y, lam_l1=0, lam_l2=0):
+        '''
+        Mean of the per-point gradients given by g_imp, computed
+        as a single matrix product, without forming them.
+        '''
+        # Args: as in g_imp.
+
+        # Output: (1 x d) matrix, the mean over the k points.
+
+        # Compute regularization terms if required.
+        if lam_l1 > 0:
+            g_l1reg = lam_l1 * (np.sign(w)).transpose()
+        else:
+            g_l1reg = 0
+        if lam_l2 > 0:
+            g_l2reg = 2 * lam_l2 * w.transpose() # grad of squared l2 norm.
+        else:
+            g_l2reg = 0
+
+        resid = mdot(X,w) - y # (k x 1)
+        g = (tdot(resid, X) / X.shape[0]).astype(self.ftype)
+        return g + g_l1reg + g_l2reg
+
+    def g_mean_tr(self, w, lam_l1=0, lam_l2=0):
+        if self.gram_mode:
+            return self.g_mean_gram(w=w, split="tr",
+                                    lam_l1=lam_l1, lam_l2=lam_l2)
+        return self.g_mean_imp(w=w, X=self.X_tr, y=self.y_tr,
+                               lam_l1=lam_l1, lam_l2=lam_l2)
+
+    def g_mean_te(self, w, lam_l1=0, lam_l2=0):
+        if self.gram_mode:
+            return self.g_mean_gram(w=w, split="te",
+                                    lam_l1=lam_l1, lam_l2=lam_l2)
+        return self.g_mean_imp(w=w, X=self.X_te, y=self.y_te,
+                               lam_l1=lam_l1, lam_l2=lam_l2)
+
+    def g_mean_batch(self, w, idx, split="tr", lam_l1=0, lam_l2=0):
+        '''
+        Mean gradient over a mini-batch, given by an array of
+        row indices into one of the splits.
+        '''
+        return self.g_mean_imp(w=w, X=getattr(self, "X_"+split)[idx],
+                               y=getattr(self, "y_"+split)[idx],
+                               lam_l1=lam_l1, lam_l2=lam_l2)
+
+    def g_stream(self, w, split="tr", size=1024, order="seq",
+                 lam_l1=0, lam_l2=0):
+        '''
+        Mean of the per-point gradients on a split, read in blocks
+        of size rows. Output is a (1 x d) matrix.
+        '''
+        k = 0
+        gsum = np.zeros((1,self.d), dtype=np.float64)
+        for X, y in self.batches(split=split, size=size, order=order):
+            gsum += X.shape[0] * self.g_mean_imp(w=w, X=X, y=y,
+                                                 lam_l1=lam_l1,
+                                                 lam_l2=lam_l2)
+            k += X.shape[0]
+        return gsum / k
+
     def g_j_imp(self, j, w, X, y, lam_l1=0, lam_l2=0):
         '''
         One coordinate of the gradient of the above
@@ -405,7 +1043,7 @@ class LinReg(classes.Data):
         else:
             g_l2reg = 0
 
-        return -(y-np.dot(X,w)) * np.take(X,[j],1) + g_l1reg + g_l2reg
+        return -(y-mdot(X,w)) * dense(X[:,[j]]) + g_l1reg + g_l2reg
     
     def g_j_tr(self, j, w, lam_l1=0, lam_l2=0):
         return self.g_j_imp(j=j, w=w, X=self.X_tr, y=self.y_tr,
@@ -415,6 +1053,18 @@ class LinReg(classes.Data):
         return self.g_j_imp(j=j, w=w, X=self.X_te, y=self.y_te,
                             lam_l1=lam_l1, lam_l2=lam_l2)
 
+    def l_mean_te(self, w, lam_l1=0, lam_l2=0):
+        if self.gram_mode:
+            return self.l_mean_gram(w=w, split="te",
+                                    lam_l1=lam_l1, lam_l2=lam_l2)
+        return np.mean(self.l_te(w=w, lam_l1=lam_l1, lam_l2=lam_l2))
+
+    def g_j_mean_te(self, j, w, lam_l1=0, lam_l2=0):
+        if self.gram_mode:
+            return self.g_j_mean_gram(j=j, w=w, split="te",
+                                      lam_l1=lam_l1, lam_l2=lam_l2)
+        return np.mean(self.g_j_te(j=j, w=w, lam_l1=lam_l1, lam_l2=lam_l2))
+
     def corr_imp(self, w, X, y):
         '''
         Wrapper for Pearson's correlation coefficient,
@@ -429,7 +1079,7 @@ class LinReg(classes.Data):
 
         # Output: a real-valued correlation coefficient.
 
-        yest = np.dot(X,w)
+        yest = mdot(X,w)
         return scipy.stats.pearsonr(yest.flatten(), y.flatten())[0]
 
     def corr_tr(self, w):
@@ -439,38 +1089,241 @@ class LinReg(classes.Data):
         return self.corr_imp(w=w, X=self.X_te, y=self.y_te)
 
 
+    def ridge_factor(self):
+        '''
+        A factorization of X_tr, computed once and kept until X_tr
+        is replaced: X_tr V = XV, with V (d x r) orthonormal and
+        XV having orthogonal columns of squared norms s2. It comes
+        from an eigendecomposition of X'X when n is at least twice
+        d, and from a thin SVD of X_tr otherwise.
+        '''
+        X = self.X_tr
+        fac = self._ridge
+        if fac.get("X") is X:
+            return fac
+
+        fac.clear()
+        fac["X"] = X
+        if X.shape[0] >= 2*X.shape[1]:
+            s2, V = np.linalg.eigh(self.gram("tr")["XtX"])
+            s2 = np.maximum(s2, 0) # rounding can leave tiny negatives.
+        else:
+            U, s, Vt = np.linalg.svd(dense(X).astype(np.float64),
+                                     full_matrices=False)
+            s2 = s**2
+            V = np.transpose(Vt)
+        fac["V"] = V
+        fac["s2"] = s2
+        fac["XV"] = mdot(X, V)
+        return fac
+
+    def ridge_coef(self, lam_l2):
+        '''
+        The factors 1/(s2 + n lam) for each lambda, as an (m x r)
+        array; directions with s2 = 0 are dropped when lam = 0.
+        '''
+        fac = self.ridge_factor()
+        lam = np.atleast_1d(np.asarray(lam_l2, dtype=np.float64)).ravel()
+        den = fac["s2"][np.newaxis,:] + self.n * lam[:,np.newaxis]
+        tiny = np.finfo(np.float64).eps * max(1.0, fac["s2"].max())
+        return np.where(den > tiny, 1 / np.where(den > tiny, den, 1), 0)
+
+    def ridge(self, lam_l2):
+        '''
+        Minimizers of the mean squared error plus lam_l2 times the
+        squared l2 norm (the loss of l_imp, with lam_l1=0), for one
+        or more values of lam_l2, from the cached factorization.
+        Each costs O(d r) after the first.
+        '''
+
+        # Output:
+        # A (d x m) array, one column of weights per lambda.
+
+        fac = self.ridge_factor()
+        z = np.dot(np.transpose(fac["XV"]), self.y_tr).ravel() # V'X'y
+        return np.dot(fac["V"], np.transpose(self.ridge_coef(lam_l2) * z))
+
+    def ridge_cv(self, lam_l2):
+        '''
+        Leave-one-out and generalized cross-validation estimates of
+        the squared error of the ridge fits on the training data,
+        for one or more values of lam_l2, from the same factorization
+        (no refitting).
+        '''
+
+        # Output:
+        # loo, gcv: arrays with one mean squared error per lambda.
+
+        fac = self.ridge_factor()
+        XV = fac["XV"]
+        y = self.y_tr.ravel()
+        z = np.dot(y, XV)
+        coef = self.ridge_coef(lam_l2) # (m x r)
+
+        resid = y[np.newaxis,:] - np.dot(coef * z, np.transpose(XV)) # (m x n)
+        hdiag = np.dot(coef, np.transpose(XV**2)) # diagonals of the hat matrices.
+        loo = np.mean((resid / (1-hdiag))**2, axis=1)
+        dof = np.dot(coef, fac["s2"]) # traces of the hat matrices.
+        gcv = np.mean(resid**2, axis=1) / (1 - dof/self.n)**2
+        return loo, gcv
+
+
 class Encoder(LinReg):
 
-    def __init__(self, dinfo):
+    # Responses are read a few rows at a time, never as a whole.
+    NO_BACKGROUND = ("y_tr", "y_te")
+    RIDGE_CHUNK = 1024 # voxels read at once by ridge_all().
+
+    def __init__(self, dinfo, mode="auto", background=False, dtype=None):
         '''
         This is an application-specific class for the motion
         energy encoder. It inherits the linear regression model,
         and the only difference is that we extract individual
         voxels at the point of initialization.
+
+        The voxel index (dinfo.misc["voxidx"]) may be a single
+        index or a list of them. Only those rows of the response
+        files are read; the responses for all of them are kept in
+        Y_tr/Y_te (one column per voxel), and y_tr/y_te hold the
+        currently selected voxel (see select()).
         '''
-        super(Encoder,self).__init__(dinfo)
+        super(Encoder,self).__init__(dinfo, mode=mode,
+                                     background=background, dtype=dtype)
 
-        # Extract a single voxel's worth of data.
+        # Extract the requested voxels' worth of data.
         # NOTE: assumes the shape is (#voxels, #points).
-        self.voxidx = dinfo.misc["voxidx"]
-        self.y_tr = np.transpose(np.take(self.y_tr, [self.voxidx], 0))
-        self.y_te = np.transpose(np.take(self.y_te, [self.voxidx], 0))
+        self.voxels = np.atleast_1d(dinfo.misc["voxidx"]).astype(np.intp)
+        self.Y_tr = np.transpose(self.read_rows("y_tr", self.voxels))
+        self.Y_te = np.transpose(self.read_rows("y_te", self.voxels))
+        if self.dtype is not None:
+            self.Y_tr = self.Y_tr.astype(self.dtype)
+            self.Y_te = self.Y_te.astype(self.dtype)
+        self.select(self.voxels[0])
+
+
+    def __str__(self):
+        # The response files are (#voxels x #points); report instead
+        # the responses held for the selected voxel.
+        s_mod = "MODEL: Encoder (linear regression), voxel "\
+                + str(self.voxidx) + " selected, " + str(self.voxels.size)\
+                + " loaded." + "\n" + "Info on data as follows..."
+        s_data = []
+        for name in self.SPLITS:
+            myar = self.__dict__.get(name)
+            shape = (myar.shape if myar is not None else self.shape_of(name))
+            s_data.append(name + ":" + str(shape))
+        return s_mod + "\n" + "\n".join(s_data) + "\n"
+
+
+    def select(self, voxidx):
+        '''
+        Make one of the loaded voxels the current one, so that
+        y_tr/y_te (and thus all losses, gradients, etc.) refer
+        to it. No data is read from disk.
+        '''
+        pos = np.flatnonzero(self.voxels == voxidx)
+        if pos.size == 0:
+            raise ValueError("Voxel " + str(voxidx) + " was not loaded.")
+        self.voxidx = voxidx
+        self.y_tr = self.Y_tr[:,pos[:1]]
+        self.y_te = self.Y_te[:,pos[:1]]
+
+
+    def ridge_all(self, lam_l2, voxels=None, chunk=None, criterion="gcv"):
+        '''
+        Ridge fits (see LinReg.ridge) for many voxels and a whole
+        grid of lambdas, in one pass over the response files. X_tr
+        is factored once; the responses are read in chunks of voxels
+        (straight from the memory-mapped files), projected onto the
+        factorization, and every lambda is then handled in r-space.
+
+        For each voxel, the best lambda is the one with the smallest
+        GCV error on the training data (criterion="gcv"), or the
+        largest test correlation (criterion="corr").
+        '''
+
+        # Input:
+        # lam_l2 is an array of m values of lambda.
+        # voxels are rows of the response files (default: all of them).
+        # chunk is the number of voxels read at once.
+
+        # Output:
+        # W, a (d x V) array of weights, at each voxel's best lambda.
+        # corr, the (m x V) test correlations, for all lambdas.
+        # gcv, the (m x V) GCV errors, for all lambdas.
+        # best, for each voxel the position of its best lambda.
+
+        if voxels is None:
+            voxels = np.arange(self.shape_of("y_tr")[0])
+        voxels = np.atleast_1d(voxels).astype(np.intp)
+        chunk = (self.RIDGE_CHUNK if chunk is None else chunk)
+        V = voxels.size
+
+        fac = self.ridge_factor()
+        coef = self.ridge_coef(lam_l2) # (m x r)
+        m = coef.shape[0]
+        XteV = mdot(self.X_te, fac["V"]) # test inputs, in r-space.
+        dof = np.dot(coef, fac["s2"]) # traces of the hat matrices.
+
+        W = np.zeros((self.d,V), dtype=np.float64)
+        corr = np.zeros((m,V), dtype=np.float64)
+        gcv = np.zeros((m,V), dtype=np.float64)
+        best = np.zeros(V, dtype=np.intp)
+
+        for i in range(0, V, chunk):
+            cols = slice(i, min(i+chunk, V))
+            Y = np.transpose(self.read_rows("y_tr", voxels[cols])).astype(np.float64)
+            Y_te = np.transpose(self.read_rows("y_te", voxels[cols]))
+            Z = np.dot(np.transpose(fac["XV"]), Y) # (r x Vc)
+            yty = np.einsum("ij,ij->j", Y, Y)
+            Z2 = Z**2
+
+            for k in range(m):
+                # Fitted coefficients in r-space, and the training
+                # error, using the orthogonality of the columns of XV.
+                C = coef[k,:,np.newaxis] * Z
+                rss = (yty - 2*np.dot(coef[k,:], Z2)
+                       + np.dot(fac["s2"] * coef[k,:]**2, Z2))
+                gcv[k,cols] = rss / self.n / (1 - dof[k]/self.n)**2
+                corr[k,cols] = corr_cols(np.dot(XteV, C), Y_te)
+
+            if criterion == "gcv":
+                best[cols] = np.argmin(gcv[:,cols], axis=0)
+            elif criterion == "corr":
+                best[cols] = np.argmax(corr[:,cols], axis=0)
+            else:
+                raise ValueError("Unknown criterion: " + str(criterion))
+
+            # Weights at each voxel's best lambda.
+            W[:,cols] = np.dot(fac["V"], coef[best[cols],:].transpose() * Z)
+
+            print("Update:", cols.stop, "of", V, "voxels")
+
+        return W, corr, gcv, best
     
 
-class NoisyOpt(classes.Data):
+class NoisyOpt(GramMixin, classes.Data):
 
-    def __init__(self, dinfo):
+    LOSS_SCALE = 1/2 # the squared errors are halved (see l_imp).
+
+    def __init__(self, dinfo, mode="auto", background=False, dtype=None):
         '''
         Model object for general-purpose noisy optimization
         demo, where we just have training data and oracle
         information for a risk function.
         '''
         # Given data info, load it up into memory for use.
-        super(NoisyOpt,self).__init__(dinfo)
-        self.n = self.X_tr.shape[0]
-        self.d = self.X_tr.shape[1]
+        super(NoisyOpt,self).__init__(dinfo, mode=mode,
+                                      background=background, dtype=dtype)
+        self.ftype = np.dtype(np.float64 if dtype is None else dtype)
+        self.n, self.d = self.shape_of("X_tr")
         self.nsub = dinfo.misc["nsub"]
 
+        # Optionally, losses and gradients on whole splits can come
+        # from X'X, X'y and y'y, computed once (see gram()).
+        self.gram_mode = False
+        self._gram = {}
+
         # Given oracle information, use it for later evaluation.
         self.sigma_noise = dinfo.misc["sigma_noise"]
         self.cov_X = dinfo.misc["cov_X"]
@@ -546,13 +1399,43 @@ class NoisyOpt(classes.Data):
         else:
             l2reg = 0
 
-        return (np.dot(X,w)-y)**2 / 2 + l1reg + l2reg
+        return (mdot(X,w)-y)**2 / 2 + l1reg + l2reg
 
 
     def l_tr(self, w, lam_l1=0, lam_l2=0):
         return self.l_imp(w=w, X=self.X_tr, y=self.y_tr,
                           lam_l1=lam_l1, lam_l2=lam_l2)
 
+    def l_batch_imp(self, W, X, y, lam_l1=0, lam_l2=0):
+        '''
+        Mean loss over k points, for each of m weight vectors,
+        with the predictions for many of them at once coming
+        from a single matrix product.
+        '''
+        # Args:
+        # W is a (d x m) matrix, one weight vector per column.
+        # X, y, lam_* are as in l_imp.
+
+        # Output: vector of length m, the mean losses.
+
+        k = X.shape[0]
+        m = W.shape[1]
+        out = np.zeros(m, dtype=np.float64)
+        for cols in chunks(m, k):
+            out[cols] = np.mean((mdot(X,W[:,cols])-y)**2, axis=0) / 2
+
+        # Compute regularization terms if required.
+        if lam_l1 > 0:
+            out += lam_l1 * np.sum(np.abs(W), axis=0) # l1 norms
+        if lam_l2 > 0:
+            out += lam_l2 * np.sum(W*W, axis=0) # squared l2
+
+        return out
+
+    def l_tr_batch(self, W, lam_l1=0, lam_l2=0):
+        return self.l_batch_imp(W=W, X=self.X_tr, y=self.y_tr,
+                                lam_l1=lam_l1, lam_l2=lam_l2)
+
 
     def g_imp(self, w, X, y, lam_l1=0, lam_l2=0):
         '''
@@ -577,13 +1460,52 @@ class NoisyOpt(classes.Data):
         else:
             g_l2reg = 0
 
-        return -(y-np.dot(X,w)) * X + g_l1reg + g_l2reg
+        return -(y-mdot(X,w)) * dense(X) + g_l1reg + g_l2reg
     
 
     def g_tr(self, w, lam_l1=0, lam_l2=0):
         return self.g_imp(w=w, X=self.X_tr, y=self.y_tr,
                           lam_l1=lam_l1, lam_l2=lam_l2)
 
+    def g_mean_imp(self, w, X, y, lam_l1=0, lam_l2=0):
+        '''
+        Mean of the per-point gradients given by g_imp, computed
+        as a single matrix product, without forming them.
+        '''
+        # Args: as in g_imp.
+
+        # Output: (1 x d) matrix, the mean over the k points.
+
+        # Compute regularization terms if required.
+        if lam_l1 > 0:
+            g_l1reg = lam_l1 * (np.sign(w)).transpose()
+        else:
+            g_l1reg = 0
+        if lam_l2 > 0:
+            g_l2reg = 2 * lam_l2 * w.transpose() # grad of squared l2 norm.
+        else:
+            g_l2reg = 0
+
+        resid = mdot(X,w) - y # (k x 1)
+        g = (tdot(resid, X) / X.shape[0]).astype(self.ftype)
+        return g + g_l1reg + g_l2reg
+
+    def g_mean_tr(self, w, lam_l1=0, lam_l2=0):
+        if self.gram_mode:
+            return self.g_mean_gram(w=w, split="tr",
+                                    lam_l1=lam_l1, lam_l2=lam_l2)
+        return self.g_mean_imp(w=w, X=self.X_tr, y=self.y_tr,
+                               lam_l1=lam_l1, lam_l2=lam_l2)
+
+    def g_mean_batch(self, w, idx, split="tr", lam_l1=0, lam_l2=0):
+        '''
+        Mean gradient over a mini-batch, given by an array of
+        row indices into one of the splits.
+        '''
+        return self.g_mean_imp(w=w, X=getattr(self, "X_"+split)[idx],
+                               y=getattr(self, "y_"+split)[idx],
+                               lam_l1=lam_l1, lam_l2=lam_l2)
+
     
     def g_j_imp(self, j, w, X, y, lam_l1=0, lam_l2=0):
         '''
@@ -613,7 +1535,7 @@ class NoisyOpt(classes.Data):
         else:
             g_l2reg = 0
 
-        return -(y-np.dot(X,w)) * np.take(X,[j],1) + g_l1reg + g_l2reg
+        return -(y-mdot(X,w)) * dense(X[:,[j]]) + g_l1reg + g_l2reg
     
     def g_j_tr(self, j, w, lam_l1=0, lam_l2=0):
         return self.g_j_imp(j=j, w=w, X=self.X_tr, y=self.y_tr,
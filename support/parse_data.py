@@ -1,90 +1,219 @@
 
 
 import support.classes as classes
+import support.container as container
+import support.cache as cache
 import os
-import pickle
 import numpy as np
-import csv
+import io
 import math
+import multiprocessing
+import gzip
+import struct
+from scipy import sparse as sp
 
 DATA_PATH = os.path.join(os.path.expanduser('~'), "learnml/data")
+CONTAINER = "data.lmd" # name of the container file in data/<data set>/.
+EXEC_PARAMS = ("nproc", "chunksize") # prep options which do not change the data.
 
-def prep(s, skipread=False):
+def prep(s, skipread=False, budget=None, dtype=None, **params):
     '''
     Takes a string with data set name, and runs the proper setup.
+
+    The result is cached (see support/cache.py): if the source files
+    and parameters are unchanged since an earlier run, the cached
+    container is returned straight away, otherwise it is rebuilt.
+    Extra keyword arguments go to the preparation function, and budget
+    overrides the cache's disk budget (in bytes). Randomly generated
+    data sets (those with no source files) are not cached: they are
+    generated afresh on every call, and written to data/<name>/.
+
+    With a dtype (e.g. np.float32), the floating-point splits are
+    stored in that dtype (integer labels are kept), so that models
+    using the same dtype can memory-map them as they are (see
+    classes.Data); the dtype is part of the cache key.
+
+    With skipread, whatever was prepared last is used without checking
+    its sources (converting an older "info.dat" data set if need be);
+    cached containers still have their checksums checked once.
     '''
 
     print("Preparing data (s =", s, ")...")
 
-    if s == "toyReg":
-        toread = os.path.join("data", s, "info.dat")
-        if skipread:
-            with open(toread, mode="br") as f:
-                dinfo = pickle.load(f)
-            return dinfo
-        else:
-            return toyReg()
-
-    if s == "toyClass":
-        toread = os.path.join("data", s, "info.dat")
-        if skipread:
-            with open(toread, mode="br") as f:
-                dinfo = pickle.load(f)
-            return dinfo
-        else:
-            return toyClass()
-
-    if s == "MNIST":
-        toread = os.path.join("data", s, "info.dat")
-        if skipread:
-            with open(toread, mode="br") as f:
-                dinfo = pickle.load(f)
-            return dinfo
-        else:
-            return MNIST()
-    
-    if s == "quantum":
-        toread = os.path.join("data", s, "info.dat")
-        if skipread:
-            with open(toread, mode="br") as f:
-                dinfo = pickle.load(f)
-            return dinfo
-        else:
-            return quantum()
-
-    if s == "NoisyOpt_isoBig":
-        toread = os.path.join("data", s, "info.dat")
-        if skipread:
-            with open(toread, mode="br") as f:
-                dinfo = pickle.load(f)
-            return dinfo
-        else:
-            return NoisyOpt_isoBig()
-
-    if s == "NoisyOpt_isoSmall":
-        toread = os.path.join("data", s, "info.dat")
-        if skipread:
-            with open(toread, mode="br") as f:
-                dinfo = pickle.load(f)
+    if s not in PREP:
+        raise ValueError("Unknown data set: " + str(s))
+
+    if skipread:
+        toread = (None if SOURCES[s] is None else cache.latest(s))
+        if toread is None:
+            toread = os.path.join("data", s, CONTAINER)
+        if not os.path.exists(toread):
+            legacy = os.path.join("data", s, "info.dat")
+            if os.path.exists(legacy):
+                print("Converting", legacy, "...")
+                return container.convert(legacy, toread)
+        return container.info(toread)
+
+    if SOURCES[s] is None:
+        dinfo = PREP[s](**params)
+        if dtype is None:
             return dinfo
-        else:
-            return NoisyOpt_isoSmall()
-
+        path = dinfo.X_tr["path"]
+        container.cast(path, path + ".tmp", dtype)
+        os.replace(path + ".tmp", path)
+        return container.info(path)
+
+    # Options which do not change the data are left out of the key,
+    # but still go to the preparation function.
+    keyparams = {k: v for k, v in params.items() if k not in EXEC_PARAMS}
+    execparams = {k: v for k, v in params.items() if k in EXEC_PARAMS}
+    build = PREP[s]
+    if dtype is not None:
+        keyparams["dtype"] = np.dtype(dtype).name
+        build = cast_build(PREP[s])
+    return cache.get(dataset=s, build=build, sources=SOURCES[s](),
+                     params=keyparams, budget=budget, exec_params=execparams)
+
+
+def cast_build(build):
+    '''
+    A preparation function which runs build, then stores the
+    floating-point splits of the result in the dtype given (see
+    container.cast).
+    '''
+    def build_as(towrite, dtype, **params):
+        build(towrite=towrite + ".tmp", **params)
+        container.cast(towrite + ".tmp", towrite, dtype)
+        os.remove(towrite + ".tmp")
+    return build_as
 
 
-def load(dinfo):
+def load(dinfo, mode="auto", background=False):
     '''
     Given the info (path to binary, shape) about a particular data set,
-    load relevant training and testing data sets.    
+    load relevant training and testing data sets. Each split is opened
+    lazily; see classes.Data for the meaning of "mode". With background,
+    this returns at once, and the reads run in background threads.
     '''
     print("Reading data...")
-    return classes.Data(dinfo)
+    return classes.Data(dinfo, mode=mode, background=background)
+
+
+def out_path(dataset, towrite=None):
+    '''
+    Where to write a data set's container (by default, in its own
+    directory under data/).
+    '''
+    if towrite is None:
+        towrite = os.path.join("data", dataset, CONTAINER)
+    dirname = os.path.dirname(towrite)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    return towrite
+
+
+def save(dataset, dinfo, arrays, towrite=None):
+    '''
+    Write the arrays of a data set, along with the model name and
+    misc information in dinfo, to its container file. Returns a
+    data info object pointing into the container.
+    '''
+    towrite = out_path(dataset, towrite)
+    print("Writing", towrite, "...")
+    container.write(towrite, arrays, mname=dinfo.mname, misc=dinfo.misc)
+    return container.info(towrite)
+
+
+QUANTUM_CHUNK = 2**24 # bytes per chunk when parsing the quantum table.
+
+
+def tsv_chunks(toread, chunksize):
+    '''
+    Split a text file into (start, stop) byte ranges of roughly
+    the given size, each ending on a line boundary.
+    '''
+    size = os.path.getsize(toread)
+    bounds = [0]
+    with open(toread, mode="rb") as f:
+        pos = chunksize
+        while pos < size:
+            f.seek(pos)
+            f.readline() # move on to the start of the next line.
+            pos = f.tell()
+            if pos >= size:
+                break
+            bounds.append(pos)
+            pos += chunksize
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def tsv_rows(toread, start, stop):
+    '''
+    The rows in a byte range of a text file: its lines, less any
+    which are blank (or only whitespace, e.g. a stray "\r"). Both
+    the counting and the parsing passes go through here, so that
+    they agree on the number of rows.
+    '''
+    with open(toread, mode="rb") as f:
+        f.seek(start)
+        b = f.read(stop-start)
+    return [line for line in b.splitlines() if line.strip()]
 
 
-def quantum():
+def tsv_count(args):
+    '''
+    Number of rows in a byte range of a text file (see tsv_rows).
+    '''
+    toread, start, stop = args
+    return len(tsv_rows(toread, start, stop))
+
+
+def quantum_chunk(args):
+    '''
+    Parse one byte range of the quantum table, and write its rows
+    straight into the memory-mapped outputs. The first n_half rows
+    of the file go to training, the next n_half to testing.
+    '''
+    toread, start, stop, row0, n_half, d, dinfo = args
+    lines = tsv_rows(toread, start, stop)
+
+    # Column 0 is an ID, column 1 the label, then d features; anything
+    # after those (a trailing tab) is ignored, as before.
+    block = np.loadtxt(io.BytesIO(b"\n".join(lines)), delimiter="\t",
+                       dtype=np.float64, usecols=range(1, d+2), ndmin=2,
+                       comments=None).reshape( (len(lines),d+1) )
+
+    rows = np.arange(row0, row0+block.shape[0])
+    for split, lo in (("tr", 0), ("te", n_half)):
+        keep = (rows >= lo) & (rows < lo+n_half)
+        if not keep.any():
+            continue
+        i0 = rows[keep][0] - lo
+        i1 = rows[keep][-1] - lo + 1
+        myd = getattr(dinfo, "X_" + split)
+        X = np.memmap(myd["path"], dtype=myd["dtype"], mode="r+",
+                      offset=myd["offset"], shape=myd["shape"])
+        X[i0:i1,:] = block[keep,1:]
+        X.flush()
+        myd = getattr(dinfo, "y_" + split)
+        y = np.memmap(myd["path"], dtype=myd["dtype"], mode="r+",
+                      offset=myd["offset"], shape=myd["shape"])
+        y[i0:i1,0] = block[keep,0].astype(np.uint8)
+        y.flush()
+        del X, y
+
+    return block.shape[0]
+
+
+def quantum(nproc=None, chunksize=QUANTUM_CHUNK, towrite=None):
     '''
     Data preparation function, specific to the "quantum physics" dataset.
     URL: http://osmot.cs.cornell.edu/kddcup/datasets.html
+
+    The table is read in chunks of (about) chunksize bytes, which are
+    parsed in parallel by a pool of nproc processes (default: all
+    cores). The number of rows and features is taken from the file.
     '''
     dataset = "quantum"
     dinfo = classes.DataInfo()
@@ -98,73 +227,43 @@ def quantum():
     # NOTE: only "train" has labels, so we split this dataset into
     # train/test subsets for a supervised learning routine.
 
-    n = 50000
-    d = 78
-    X_tr = np.zeros( (n//2,d), dtype=np.float64 )
-    y_tr = np.zeros( (n//2,1), dtype=np.uint8 )
-    X_te = np.zeros( (n//2,d), dtype=np.float64 )
-    y_te = np.zeros( (n//2,1), dtype=np.uint8 )
-    
-    with open(toread, newline="") as f_table:
-        f_reader = csv.reader(f_table, delimiter="\t")
-        idx = 0
-        switcher = True
-        for line in f_reader:
-
-            # Arbitrarily let first half be training, second half testing.
-            if switcher:
-                y_tr[idx,0] = np.uint8(line[1])
-                X_tr[idx,:] = np.array(line[2:-1], dtype=np.float64)
-                idx += 1
-            else:
-                y_te[idx,0] = np.uint8(line[1])
-                X_te[idx,:] = np.array(line[2:-1], dtype=np.float64)
-                idx += 1
-
-            # Once we've covered half the data, start on test data.
-            if idx == n//2:
-                switcher = False
-                idx = 0
-
-    print("Writing inputs...")
-    towrite = os.path.join("data", dataset, ("X_tr" + ".dat"))
-    with open(towrite, mode="bw") as g_bin:
-        X_tr.tofile(g_bin)
-    dinfo.X_tr["shape"] = (n//2,d)
-    dinfo.X_tr["path"] = towrite
-    dinfo.X_tr["dtype"] = np.float64
-    towrite = os.path.join("data", dataset, ("X_te" + ".dat"))
-    with open(towrite, mode="bw") as g_bin:
-        X_te.tofile(g_bin)
-    dinfo.X_te["shape"] = (n//2,d)
-    dinfo.X_te["path"] = towrite
-    dinfo.X_te["dtype"] = np.float64
-
-    print("Writing outputs...")
-    towrite = os.path.join("data", dataset, ("y_tr" + ".dat"))
-    with open(towrite, mode="bw") as g_bin:
-        y_tr.tofile(g_bin)
-    dinfo.y_tr["shape"] = (n//2,1)
-    dinfo.y_tr["path"] = towrite
-    dinfo.y_tr["dtype"] = np.uint8
-    towrite = os.path.join("data", dataset, ("y_te" + ".dat"))
-    with open(towrite, mode="bw") as g_bin:
-        y_te.tofile(g_bin)
-    dinfo.y_te["shape"] = (n//2,1)
-    dinfo.y_te["path"] = towrite
-    dinfo.y_te["dtype"] = np.uint8
-
-    # Save the dinfo dictionary for future use (so we don't have to read
-    # the original data every time).
-    towrite = os.path.join("data", dataset, "info.dat")
-    with open(towrite, mode="wb") as f:
-        pickle.dump(dinfo, f)
+    # Number of features, from the first line (ID, label, features, "").
+    with open(toread, mode="rb") as f:
+        d = len(f.readline().split(b"\t")) - 3
+
+    chunks = tsv_chunks(toread, chunksize)
+
+    with multiprocessing.Pool(processes=nproc) as pool:
+
+        # First pass: line counts per chunk, giving each chunk's first row.
+        counts = pool.map(tsv_count, [(toread, a, b) for a, b in chunks])
+        n = sum(counts)
+        row0 = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+        # Arbitrarily let first half be training, second half testing.
+        print("Writing inputs and outputs...")
+        towrite = out_path(dataset, towrite)
+        out = container.create(towrite,
+                               [("X_tr", (n//2,d), np.float64),
+                                ("X_te", (n//2,d), np.float64),
+                                ("y_tr", (n//2,1), np.uint8),
+                                ("y_te", (n//2,1), np.uint8)],
+                               mname=dinfo.mname)
+        del out
+        dinfo = container.info(towrite)
+
+        # Second pass: parse and write all chunks.
+        todo = [(toread, a, b, int(r), n//2, d, dinfo)
+                for (a, b), r in zip(chunks, row0)]
+        pool.map(quantum_chunk, todo)
+
+    container.finalize(towrite)
 
     # Finally, return the dinfo dict.
     return dinfo
 
 
-def toyReg():
+def toyReg(towrite=None):
     '''
     Data preparation function, for a small toy set of data,
     to be solved using a linear regression model.
@@ -186,54 +285,18 @@ def toyReg():
     X_te = np.random.normal(loc=0.0, scale=0.5, size=m*d).reshape((m,d))
     noise_te = np.random.normal(loc=0.0, scale=1.0, size=m).reshape((m,1))
     
-    # Inputs (training)
-    towrite = os.path.join("data", dataset, ("X_tr" + ".dat"))
-    data_arr = X_tr
-    dinfo.X_tr["shape"] = data_arr.shape
-    dinfo.X_tr["path"] = towrite
-    dinfo.X_tr["dtype"] = data_arr.dtype
-    with open(towrite, mode="bw") as g_bin:
-        data_arr.tofile(g_bin)
-
-    # Inputs (testing)
-    towrite = os.path.join("data", dataset, ("X_te" + ".dat"))
-    data_arr = X_te
-    dinfo.X_te["shape"] = data_arr.shape
-    dinfo.X_te["path"] = towrite
-    dinfo.X_te["dtype"] = data_arr.dtype    
-    with open(towrite, mode="bw") as g_bin:
-        data_arr.tofile(g_bin)
-
-    # Outputs (training)
-    towrite = os.path.join("data", dataset, ("y_tr" + ".dat"))
-    data_arr = (np.dot(X_tr,w_true)+noise_tr).reshape((X_tr.shape[0],1))
-    dinfo.y_tr["shape"] = data_arr.shape
-    dinfo.y_tr["path"] = towrite
-    dinfo.y_tr["dtype"] = data_arr.dtype
-    with open(towrite, mode="bw") as g_bin:
-        data_arr.tofile(g_bin)
-
-    # Outputs (testing)
-    towrite = os.path.join("data", dataset, ("y_te" + ".dat"))
-    data_arr = (np.dot(X_te,w_true)+noise_te).reshape((X_te.shape[0],1))
-    dinfo.y_te["shape"] = data_arr.shape
-    dinfo.y_te["path"] = towrite
-    dinfo.y_te["dtype"] = data_arr.dtype
-    with open(towrite, mode="bw") as g_bin:
-        data_arr.tofile(g_bin)
-
-    # Save the dinfo dictionary for future use (so we don't have to read
-    # the original data every time).
-
-    towrite = os.path.join("data", dataset, "info.dat")
-    with open(towrite, mode="wb") as f:
-        pickle.dump(dinfo, f)
+    # Outputs (noisy linear responses).
+    y_tr = (np.dot(X_tr,w_true)+noise_tr).reshape((X_tr.shape[0],1))
+    y_te = (np.dot(X_te,w_true)+noise_te).reshape((X_te.shape[0],1))
 
-    # Finally, return the dinfo dict.
-    return dinfo
+    # Save everything in one container for future use (so we don't
+    # have to generate the data every time), and return its info.
+    return save(dataset, dinfo, {"X_tr": X_tr, "X_te": X_te,
+                                 "y_tr": y_tr, "y_te": y_te},
+                towrite=towrite)
 
 
-def toyClass():
+def toyClass(towrite=None):
     '''
     Data preparation function, for a small toy set of data,
     designed for classification using a multi-class logistic
@@ -284,57 +347,133 @@ def toyClass():
         probs = P[:,i]
         y_te[i,0] = np.random.choice(nc, size=1, replace=True, p=probs)
 
-    # Write inputs (training).
-    towrite = os.path.join("data", dataset, ("X_tr" + ".dat"))
-    data_arr = X_tr
-    dinfo.X_tr["shape"] = data_arr.shape
-    dinfo.X_tr["path"] = towrite
-    dinfo.X_tr["dtype"] = data_arr.dtype
-    with open(towrite, mode="bw") as g_bin:
-        data_arr.tofile(g_bin)
-
-    # Write inputs (testing).
-    towrite = os.path.join("data", dataset, ("X_te" + ".dat"))
-    data_arr = X_te
-    dinfo.X_te["shape"] = data_arr.shape
-    dinfo.X_te["path"] = towrite
-    dinfo.X_te["dtype"] = data_arr.dtype    
-    with open(towrite, mode="bw") as g_bin:
-        data_arr.tofile(g_bin)
-
-    # Write outputs (training).
-    towrite = os.path.join("data", dataset, ("y_tr" + ".dat"))
-    data_arr = y_tr
-    dinfo.y_tr["shape"] = data_arr.shape
-    dinfo.y_tr["path"] = towrite
-    dinfo.y_tr["dtype"] = data_arr.dtype
-    with open(towrite, mode="bw") as g_bin:
-        data_arr.tofile(g_bin)
-
-    # Write outputs (testing).
-    towrite = os.path.join("data", dataset, ("y_te" + ".dat"))
-    data_arr = y_te
-    dinfo.y_te["shape"] = data_arr.shape
-    dinfo.y_te["path"] = towrite
-    dinfo.y_te["dtype"] = data_arr.dtype
-    with open(towrite, mode="bw") as g_bin:
-        data_arr.tofile(g_bin)        
-
-    # Save the dinfo dictionary for future use (so we don't have to read
-    # the original data every time).
-
-    towrite = os.path.join("data", dataset, "info.dat")
-    with open(towrite, mode="wb") as f:
-        pickle.dump(dinfo, f)
+    # Save everything in one container for future use (so we don't
+    # have to generate the data every time), and return its info.
+    return save(dataset, dinfo, {"X_tr": X_tr, "X_te": X_te,
+                                 "y_tr": y_tr, "y_te": y_te},
+                towrite=towrite)
 
-    # Finally, return the dinfo dict.
-    return dinfo
 
+# IDX type codes (third byte of the magic number) and their dtypes.
+# Multi-byte types are big-endian in the file.
+IDX_DTYPES = {0x08: np.dtype(np.uint8),
+              0x09: np.dtype(np.int8),
+              0x0B: np.dtype(">i2"),
+              0x0C: np.dtype(">i4"),
+              0x0D: np.dtype(">f4"),
+              0x0E: np.dtype(">f8")}
+
+IDX_BLOCK = 2**22 # bytes per block when streaming IDX payloads.
 
-def MNIST():
+
+def idx_open(path):
+    '''
+    Open an IDX file for binary reading. Files ending in ".gz" are
+    decompressed on the fly as they are read.
+    '''
+    if path.endswith(".gz"):
+        return gzip.open(path, mode="rb")
+    return open(path, mode="rb")
+
+
+def idx_header(f):
+    '''
+    Read and validate the header of an IDX file, leaving the file
+    positioned at the start of the payload.
+
+    Output: the dtype of the payload, and a tuple of its dims.
+    '''
+    magic = f.read(4)
+    if len(magic) != 4 or magic[0] != 0 or magic[1] != 0:
+        raise ValueError("Not an IDX file (bad magic number).")
+    if magic[2] not in IDX_DTYPES:
+        raise ValueError("Unknown IDX type code: " + hex(magic[2]))
+    ndim = magic[3]
+    if ndim == 0:
+        raise ValueError("IDX file has no dimensions.")
+    b = f.read(4*ndim)
+    if len(b) != 4*ndim:
+        raise ValueError("IDX header is truncated.")
+    dims = struct.unpack(">" + "I"*ndim, b)
+    return IDX_DTYPES[magic[2]], dims
+
+
+def idx_payload(f, dtype, dims):
+    '''
+    Read the payload of an IDX file positioned just after its
+    header (see idx_header), in a single bulk read.
+    '''
+    count = int(np.prod(dims))
+    if isinstance(f, gzip.GzipFile):
+        b = f.read(count*dtype.itemsize)
+        data_arr = np.frombuffer(b, dtype=dtype, count=len(b)//dtype.itemsize)
+    else:
+        data_arr = np.fromfile(f, dtype=dtype, count=count)
+    if data_arr.size != count:
+        raise ValueError("IDX payload is truncated.")
+
+    return data_arr.astype(dtype.newbyteorder("="), copy=False).reshape(dims)
+
+
+def idx_read(path):
+    '''
+    Read a whole IDX file (optionally gzipped) into an array of
+    the shape given in its header.
+    '''
+    with idx_open(path) as f:
+        dtype, dims = idx_header(f)
+        return idx_payload(f, dtype, dims)
+
+
+def idx_into(toread, out):
+    '''
+    Read the payload of an IDX file (optionally gzipped) into a
+    pre-allocated, writable array of matching size (e.g. a memory
+    map of the output file), in native byte order. Single-byte
+    payloads are streamed through in blocks, with no intermediate
+    copy of the data.
+    '''
+    with idx_open(toread) as f:
+        dtype, dims = idx_header(f)
+        if out.size != int(np.prod(dims)):
+            raise ValueError("IDX dims " + str(dims) + " do not match the"
+                             + " output shape " + str(out.shape))
+
+        if dtype.itemsize > 1:
+            out[...] = idx_payload(f, dtype, dims).reshape(out.shape)
+            return
+
+        buf = memoryview(out.reshape(-1).view(np.uint8))
+        pos = 0
+        while pos < len(buf):
+            k = f.readinto(buf[pos:(pos+IDX_BLOCK)])
+            if not k:
+                raise ValueError("IDX payload is truncated: " + toread)
+            pos += k
+
+
+def idx_path(dataset, fname):
+    '''
+    Locate a raw IDX file, falling back to its gzipped form.
+    '''
+    toread = os.path.join(DATA_PATH, dataset, fname)
+    if not os.path.exists(toread) and os.path.exists(toread + ".gz"):
+        toread = toread + ".gz"
+    return toread
+
+
+MNIST_FILES = [("Inputs (training)...", "X_tr", "train-images-idx3-ubyte"),
+               ("Inputs (testing)...", "X_te", "t10k-images-idx3-ubyte"),
+               ("Outputs (training)...", "y_tr", "train-labels-idx1-ubyte"),
+               ("Outputs (testing)...", "y_te", "t10k-labels-idx1-ubyte")]
+
+
+def MNIST(towrite=None, sparse=False):
     '''
     Data preparation function, specific to the MNIST handwritten
-    digits data set. 
+    digits data set. Either the raw or the gzipped IDX files
+    may be present. With sparse, the inputs (mostly zero pixels)
+    are stored in CSR form, and are opened as scipy.sparse matrices.
     URL: http://yann.lecun.com/exdb/mnist/
     '''
     dataset = "MNIST"
@@ -342,150 +481,51 @@ def MNIST():
     dinfo.mname = "LgstReg" # hard-coded model name.
 
     print("Preparation (", dataset, ")...")
-    print("Inputs (training)...")
-    toread = os.path.join(DATA_PATH,
-                          dataset,
-                          "train-images-idx3-ubyte")
-    towrite = os.path.join("data", dataset, ("X_tr" + ".dat"))
-    with open(toread, mode="rb") as f_bin:
-    
-        f_bin.seek(4)
-        b = f_bin.read(4)
-        n = int.from_bytes(b, byteorder="big")
-        b = f_bin.read(4)
-        d_rows = int.from_bytes(b, byteorder="big")
-        b = f_bin.read(4)
-        d_cols = int.from_bytes(b, byteorder="big")
-        d = d_rows * d_cols
-
-        with open(towrite, mode="bw") as g_bin:
-    
-            bytes_left = n * d
-            idx = 0
-            data_arr = np.empty( (n*d), dtype=np.uint8 )
-            while bytes_left > 0:
-                b = f_bin.read(1)
-                data_arr[idx] = np.uint8(int.from_bytes(b, byteorder="big"))
-                bytes_left -= 1
-                idx += 1
-            
-            data_arr.tofile(g_bin)
-            
-    dinfo.X_tr["shape"] = (n,d)
-    dinfo.X_tr["path"] = towrite
-    dinfo.X_tr["dtype"] = np.uint8
-
-    # --------------------------- #
-
-    print("Inputs (testing)...")
-    toread = os.path.join(DATA_PATH,
-                          dataset,
-                          "t10k-images-idx3-ubyte")
-    towrite = os.path.join("data", dataset, ("X_te" + ".dat"))
-    with open(toread, mode="rb") as f_bin:
-    
-        f_bin.seek(4)
-        b = f_bin.read(4)
-        n = int.from_bytes(b, byteorder="big")
-        b = f_bin.read(4)
-        d_rows = int.from_bytes(b, byteorder="big")
-        b = f_bin.read(4)
-        d_cols = int.from_bytes(b, byteorder="big")
-        d = d_rows * d_cols
-
-        with open(towrite, mode="bw") as g_bin:
-        
-            bytes_left = n * d
-            idx = 0
-            data_arr = np.empty( (n*d), dtype=np.uint8 )
-            while bytes_left > 0:
-                b = f_bin.read(1)
-                data_arr[idx] = np.uint8(int.from_bytes(b, byteorder="big"))
-                bytes_left -= 1
-                idx += 1
-
-            data_arr.tofile(g_bin)
-            
-    dinfo.X_te["shape"] = (n,d)
-    dinfo.X_te["path"] = towrite
-    dinfo.X_te["dtype"] = np.uint8
-
-    # --------------------------- #
-
-    print("Outputs (training)...")
-    toread = os.path.join(DATA_PATH,
-                          dataset,
-                          "train-labels-idx1-ubyte")
-    towrite = os.path.join("data", dataset, ("y_tr" + ".dat"))
-    with open(toread, mode="rb") as f_bin:
-    
-        f_bin.seek(4)
-        b = f_bin.read(4)
-        n = int.from_bytes(b, byteorder="big")
-        d = 1
-        
-        with open(towrite, mode="bw") as g_bin:
-        
-            bytes_left = n * d
-            idx = 0
-            data_arr = np.empty( (n*d), dtype=np.uint8 )
-            while bytes_left > 0:
-                b = f_bin.read(1)
-                data_arr[idx] = np.uint8(int.from_bytes(b, byteorder="big"))
-                bytes_left -= 1
-                idx += 1
-
-            data_arr.tofile(g_bin)
-
-    dinfo.y_tr["shape"] = (n,d)
-    dinfo.y_tr["path"] = towrite
-    dinfo.y_tr["dtype"] = np.uint8
-
-
-    # --------------------------- #
-
-    print("Outputs (testing)...")
-    toread = os.path.join(DATA_PATH,
-                          dataset,
-                          "t10k-labels-idx1-ubyte")
-    towrite = os.path.join("data", dataset, ("y_te" + ".dat"))
-    with open(toread, mode="rb") as f_bin:
-    
-        f_bin.seek(4)
-        b = f_bin.read(4)
-        n = int.from_bytes(b, byteorder="big")
-        d = 1
-    
-        with open(towrite, mode="bw") as g_bin:
-        
-            bytes_left = n * d
-            idx = 0
-            data_arr = np.empty( (n*d), dtype=np.uint8 )
-            while bytes_left > 0:
-                b = f_bin.read(1)
-                data_arr[idx] = np.uint8(int.from_bytes(b, byteorder="big"))
-                bytes_left -= 1
-                idx += 1
-            
-            data_arr.tofile(g_bin)
-
-    dinfo.y_te["shape"] = (n,d)
-    dinfo.y_te["path"] = towrite
-    dinfo.y_te["dtype"] = np.uint8
-
-
-    # Save the dinfo dictionary for future use (so we don't have to read
-    # the original data every time).
-    towrite = os.path.join("data", dataset, "info.dat")
-    with open(towrite, mode="wb") as f:
-        pickle.dump(dinfo, f)
-
-    # Finally, return the dinfo dict.
-    return dinfo
-
-
 
-def NoisyOpt_isoBig():
+    todo = MNIST_FILES
+
+    # Pixels stay uint8; models read them as x_scale * x + x_offset.
+    dinfo.misc["x_scale"] = 1 / 255
+    dinfo.misc["x_offset"] = 0.0
+
+    # In CSR form, the inputs are read whole, then converted.
+    if sparse:
+        arrays = {}
+        for msg, split, fname in todo:
+            print(msg)
+            arr = idx_read(idx_path(dataset, fname))
+            arr = arr.reshape( (arr.shape[0],-1) )
+            arrays[split] = (sp.csr_matrix(arr) if split.startswith("X_") else arr)
+        return save(dataset, dinfo, arrays, towrite=towrite)
+
+    # Lay out the container from the IDX headers. Images are flattened
+    # to one row each; labels are one column.
+    specs = []
+    for msg, split, fname in todo:
+        with idx_open(idx_path(dataset, fname)) as f:
+            dtype, dims = idx_header(f)
+        specs.append((split, (dims[0], int(np.prod(dims[1:]))),
+                      dtype.newbyteorder("=")))
+
+    towrite = out_path(dataset, towrite)
+    out = container.create(towrite, specs, mname=dinfo.mname,
+                           misc=dinfo.misc)
+
+    # Then stream each payload straight into its place in the file.
+    for msg, split, fname in todo:
+        print(msg)
+        idx_into(idx_path(dataset, fname), out[split])
+        out[split].flush()
+    del out
+
+    # Save the checksums, so we don't have to read the original data
+    # every time, and return the info.
+    container.finalize(towrite)
+    return container.info(towrite)
+
+
+
+def NoisyOpt_isoBig(towrite=None):
     '''
     Data preparation routine for "noisy optimization" demo,
     where inputs are generated from a linear model with
@@ -522,35 +562,16 @@ def NoisyOpt_isoBig():
     dinfo.misc["w_true"] = w_true # store the true model paras.
     dinfo.misc["w_init"] = w_true + delta # store a fixed initial value
 
-    # Inputs
-    towrite = os.path.join("data", dataset, ("X_tr" + ".dat"))
-    data_arr = X_tr
-    dinfo.X_tr["shape"] = data_arr.shape
-    dinfo.X_tr["path"] = towrite
-    dinfo.X_tr["dtype"] = data_arr.dtype
-    with open(towrite, mode="bw") as g_bin:
-        data_arr.tofile(g_bin)
-
     # Outputs
-    towrite = os.path.join("data", dataset, ("y_tr" + ".dat"))
-    data_arr = (np.dot(X_tr,w_true)+noise_tr).reshape((X_tr.shape[0],1))
-    dinfo.y_tr["shape"] = data_arr.shape
-    dinfo.y_tr["path"] = towrite
-    dinfo.y_tr["dtype"] = data_arr.dtype
-    with open(towrite, mode="bw") as g_bin:
-        data_arr.tofile(g_bin)
-
-    # Save the dinfo dictionary for future use (so we don't have to read
-    # the original data every time).
-    towrite = os.path.join("data", dataset, "info.dat")
-    with open(towrite, mode="wb") as f:
-        pickle.dump(dinfo, f)
+    y_tr = (np.dot(X_tr,w_true)+noise_tr).reshape((X_tr.shape[0],1))
 
-    # Finally, return the dinfo dict.
-    return dinfo
+    # Save everything in one container for future use (so we don't
+    # have to generate the data every time), and return its info.
+    return save(dataset, dinfo, {"X_tr": X_tr, "y_tr": y_tr},
+                towrite=towrite)
 
 
-def NoisyOpt_isoSmall():
+def NoisyOpt_isoSmall(towrite=None):
     '''
     Data preparation routine for "noisy optimization" demo,
     where inputs are generated from a linear model with
@@ -587,35 +608,16 @@ def NoisyOpt_isoSmall():
     dinfo.misc["w_true"] = w_true # store the true model paras.
     dinfo.misc["w_init"] = w_true + delta # store a fixed initial value
     
-    # Inputs
-    towrite = os.path.join("data", dataset, ("X_tr" + ".dat"))
-    data_arr = X_tr
-    dinfo.X_tr["shape"] = data_arr.shape
-    dinfo.X_tr["path"] = towrite
-    dinfo.X_tr["dtype"] = data_arr.dtype
-    with open(towrite, mode="bw") as g_bin:
-        data_arr.tofile(g_bin)
-
     # Outputs
-    towrite = os.path.join("data", dataset, ("y_tr" + ".dat"))
-    data_arr = (np.dot(X_tr,w_true)+noise_tr).reshape((X_tr.shape[0],1))
-    dinfo.y_tr["shape"] = data_arr.shape
-    dinfo.y_tr["path"] = towrite
-    dinfo.y_tr["dtype"] = data_arr.dtype
-    with open(towrite, mode="bw") as g_bin:
-        data_arr.tofile(g_bin)
-
-    # Save the dinfo dictionary for future use (so we don't have to read
-    # the original data every time).
-    towrite = os.path.join("data", dataset, "info.dat")
-    with open(towrite, mode="wb") as f:
-        pickle.dump(dinfo, f)
+    y_tr = (np.dot(X_tr,w_true)+noise_tr).reshape((X_tr.shape[0],1))
 
-    # Finally, return the dinfo dict.
-    return dinfo
+    # Save everything in one container for future use (so we don't
+    # have to generate the data every time), and return its info.
+    return save(dataset, dinfo, {"X_tr": X_tr, "y_tr": y_tr},
+                towrite=towrite)
 
 
-def NoisyOpt_SmallSparse():
+def NoisyOpt_SmallSparse(towrite=None):
     '''
     A small simulated data set based on a linear regression model
     with additive noise and a sparse underlying model vector. This
@@ -667,32 +669,32 @@ def NoisyOpt_SmallSparse():
     dinfo.mname = "NoisyOpt" # hard-coded model name.
     dinfo.misc["nsub"] = n # no sub-sampling, use whole batch.
     
-    # Inputs
-    towrite = os.path.join("data", dataset, ("X_tr" + ".dat"))
-    data_arr = X_tr
-    dinfo.X_tr["shape"] = data_arr.shape
-    dinfo.X_tr["path"] = towrite
-    dinfo.X_tr["dtype"] = data_arr.dtype
-    with open(towrite, mode="bw") as g_bin:
-        data_arr.tofile(g_bin)
-
     # Outputs
-    towrite = os.path.join("data", dataset, ("y_tr" + ".dat"))
-    data_arr = (np.dot(X_tr,w_true)+noise_tr).reshape((X_tr.shape[0],1))
-    dinfo.y_tr["shape"] = data_arr.shape
-    dinfo.y_tr["path"] = towrite
-    dinfo.y_tr["dtype"] = data_arr.dtype
-    with open(towrite, mode="bw") as g_bin:
-        data_arr.tofile(g_bin)
-
-    dinfo.X_te = None # Have an oracle
-    dinfo.y_te = None
-
-    # Save the dinfo dictionary for future use (so we don't have to read
-    # the original data every time).
-    towrite = os.path.join("data", dataset, "info.dat")
-    with open(towrite, mode="wb") as f:
-        pickle.dump(dinfo, f)
-
-    # Finally, return the dinfo dict.
-    return dinfo
+    y_tr = (np.dot(X_tr,w_true)+noise_tr).reshape((X_tr.shape[0],1))
+
+    # Save everything in one container for future use (so we don't
+    # have to generate the data every time), and return its info.
+    return save(dataset, dinfo, {"X_tr": X_tr, "y_tr": y_tr},
+                towrite=towrite)
+
+
+# Data set names, and the functions which prepare them.
+PREP = {"toyReg": toyReg,
+        "toyClass": toyClass,
+        "MNIST": MNIST,
+        "quantum": quantum,
+        "NoisyOpt_isoBig": NoisyOpt_isoBig,
+        "NoisyOpt_isoSmall": NoisyOpt_isoSmall,
+        "NoisyOpt_SmallSparse": NoisyOpt_SmallSparse}
+
+# Data set names, and the raw source files each one is built from
+# (None for randomly generated sets, which are never cached).
+SOURCES = {"toyReg": None,
+           "toyClass": None,
+           "MNIST": lambda: [idx_path("MNIST", fname)
+                             for msg, split, fname in MNIST_FILES],
+           "quantum": lambda: [os.path.join(DATA_PATH, "quantum",
+                                            "phy_train.dat")],
+           "NoisyOpt_isoBig": None,
+           "NoisyOpt_isoSmall": None,
+           "NoisyOpt_SmallSparse": None}
@@ -3,26 +3,35 @@
 
 import support.models as md
 
-def model(dinfo):
+def model(dinfo, mode="auto", background=False, dtype=None):
     '''
     A general-purpose wrapper for model classes.
 
-    Input: a data info object.
+    Input: a data info object, and the load mode passed on to
+    classes.Data ("auto", "mmap", or "read"). With background, the
+    data is read in background threads, and the model object is
+    returned as soon as its own set-up is done. With a dtype
+    (e.g. np.float32), inputs, weights, activations and gradients
+    are kept in that precision (see the model classes).
 
     Output: an instance of the desired model.
     '''
     
     # Return the appropriate model object.
     if dinfo.mname == "LgstReg":
-        return md.LgstReg(dinfo)
+        return md.LgstReg(dinfo, mode=mode, background=background,
+                          dtype=dtype)
 
     if dinfo.mname == "LinReg":
-        return md.LinReg(dinfo)
+        return md.LinReg(dinfo, mode=mode, background=background,
+                         dtype=dtype)
 
     if dinfo.mname == "Encoder":
-        return md.Encoder(dinfo)
+        return md.Encoder(dinfo, mode=mode, background=background,
+                          dtype=dtype)
 
     if dinfo.mname == "NoisyOpt":
-        return md.NoisyOpt(dinfo)
+        return md.NoisyOpt(dinfo, mode=mode, background=background,
+                           dtype=dtype)
 
 
@@ -0,0 +1,207 @@
+'''
+Readers for the vim-2 stimulus arrays ("st" and "sv" in Stimuli.mat),
+which are stored as HDF5 (via PyTables) with shape (frames, channels,
+width, height).
+
+Only the frames asked for are read, in blocks aligned with the HDF5
+chunks of the array, and the axis swaps used in the notebooks are
+applied block by block as the frames are read:
+
+  layout="raw"  : (frames, channels, width, height), as stored.
+  layout="play" : (frames, channels, height, width), for display.
+  layout="HWCT" : (height, width, channels, frames), for resizing
+                  and feature extraction.
+
+Frames can also be downsampled in parallel straight into a float32
+memory map of shape (height, width, channels, frames); see downsample().
+'''
+
+import multiprocessing
+import numpy as np
+import tables
+from skimage import transform as trans
+
+MAX_RUN = 256 # most frames read in one slice from unchunked arrays.
+DS_BLOCK = 512 # frames per task when downsampling.
+
+
+def select_frames(num_frames, idx=None, stride=None, start=0, stop=None):
+    '''
+    The frame indices to read: either those given in idx, or
+    every stride-th frame from start up to (not including) stop.
+    '''
+    if idx is not None:
+        frames = np.asarray(idx, dtype=np.int64).ravel()
+        if frames.size and (frames.min() < 0 or frames.max() >= num_frames):
+            raise IndexError("Frame index out of range.")
+        return frames
+    stop = (num_frames if stop is None else min(stop, num_frames))
+    return np.arange(start, stop, (1 if stride is None else stride))
+
+
+def frame_runs(frames, chunk):
+    '''
+    Split frame indices into groups which are each read with one
+    slice: frames within the same chunk for chunked arrays, or
+    runs of consecutive frames for contiguous ones.
+    '''
+    order = np.argsort(frames, kind="stable")
+    srt = frames[order]
+    if chunk:
+        cut = np.flatnonzero(np.diff(srt // chunk)) + 1
+    else:
+        cut = np.flatnonzero(np.diff(srt) != 1) + 1
+    runs = []
+    for pos in np.split(order, cut):
+        for i in range(0, pos.size, (chunk or MAX_RUN)):
+            runs.append(pos[i:(i+(chunk or MAX_RUN))])
+    return runs
+
+
+def arrange(block, layout):
+    '''
+    Put a (frames, channels, width, height) block into a layout.
+    '''
+    if layout == "raw":
+        return block
+    if layout == "play":
+        return np.swapaxes(block, 3, 2)
+    if layout == "HWCT":
+        return np.transpose(block, (3,2,1,0))
+    raise ValueError("Unknown layout: " + str(layout))
+
+
+def layout_shape(shape, k, layout):
+    '''
+    Shape of k frames of an array of the given shape, in a layout.
+    '''
+    num_channels, width, height = shape[1:]
+    return {"raw": (k, num_channels, width, height),
+            "play": (k, num_channels, height, width),
+            "HWCT": (height, width, num_channels, k)}[layout]
+
+
+def iter_frames(node, frames, layout="raw"):
+    '''
+    Iterate over the requested frames of an open PyTables array,
+    one chunk-aligned read at a time. Yields (pos, block) pairs,
+    where pos gives the positions of the block's frames within
+    the frames array, and block is in the given layout.
+    '''
+    chunk = (node.chunkshape[0] if node.chunkshape else None)
+    for pos in frame_runs(frames, chunk):
+        sel = frames[pos]
+        lo = sel.min()
+        hi = sel.max() + 1
+        block = node[lo:hi] # one slice, covering whole chunks.
+        if sel.size != hi - lo or np.any(np.diff(sel) != 1):
+            block = block[sel-lo]
+        yield pos, arrange(block, layout)
+
+
+def read_frames(path, name, idx=None, stride=None, start=0, stop=None,
+                layout="raw", out=None):
+    '''
+    Read selected frames of a stimulus array (e.g. name="st") from
+    the file at path. Frames are chosen by idx, or by stride/start/
+    stop (see select_frames), and returned in the given layout. The
+    result is written into out, if given (e.g. a memory map).
+    '''
+    with tables.open_file(path, mode="r") as f:
+        node = f.get_node(where="/", name=name)
+        frames = select_frames(node.shape[0], idx=idx, stride=stride,
+                               start=start, stop=stop)
+        shape = layout_shape(node.shape, frames.size, layout)
+        if out is None:
+            out = np.empty(shape, dtype=node.dtype)
+        elif out.shape != shape:
+            raise ValueError("Output has shape " + str(out.shape)
+                             + ", expected " + str(shape))
+
+        for pos, block in iter_frames(node, frames, layout=layout):
+            if layout == "HWCT":
+                out[...,pos] = block
+            else:
+                out[pos] = block
+
+    return out
+
+
+def resize_block(block, ds_shape):
+    '''
+    Resize a (height, width, channels, frames) block of images to
+    ds_shape, with values scaled to [0,1] as skimage does for
+    integer images. When the sizes divide evenly, each output pixel
+    is simply the mean over its block of input pixels (an area average,
+    rather than skimage's smoothed interpolation); otherwise the whole
+    block goes through skimage's resize at once (frames and channels
+    are left as they are).
+    '''
+    H, W = block.shape[:2]
+    h, w = ds_shape
+    if np.issubdtype(block.dtype, np.integer):
+        scale = np.float32(1 / np.iinfo(block.dtype).max)
+    else:
+        scale = np.float32(1)
+
+    if H % h == 0 and W % w == 0:
+        fh = H // h
+        fw = W // w
+        out = block.reshape((h, fh, w, fw) + block.shape[2:])
+        return out.mean(axis=(1,3), dtype=np.float32) * scale
+
+    return trans.resize(image=block.astype(np.float32) * scale,
+                        output_shape=(h, w) + block.shape[2:],
+                        mode="reflect").astype(np.float32)
+
+
+def downsample_task(args):
+    '''
+    Read a group of frames, resize them, and write them into their
+    places in the memory-mapped output.
+    '''
+    path, name, frames, pos, towrite, shape, ds_shape = args
+    out = np.memmap(towrite, dtype=np.float32, mode="r+", shape=shape)
+    with tables.open_file(path, mode="r") as f:
+        node = f.get_node(where="/", name=name)
+        for p, block in iter_frames(node, frames, layout="HWCT"):
+            out[...,pos[p]] = resize_block(block, ds_shape)
+    out.flush()
+    del out
+    return frames.size
+
+
+def downsample(path, name, towrite, ds_shape, idx=None, stride=None,
+               start=0, stop=None, nproc=None, block=DS_BLOCK):
+    '''
+    Downsample selected frames of a stimulus array to ds_shape
+    (height, width), writing the result to a float32 memory map
+    at towrite, of shape (height, width, channels, frames).
+
+    Frames (chosen as in read_frames) are split into tasks of block
+    frames each, run by a pool of nproc processes (default: all
+    cores); each task reads and resizes only its own frames, so
+    peak memory does not depend on the number of frames.
+    '''
+    with tables.open_file(path, mode="r") as f:
+        node = f.get_node(where="/", name=name)
+        frames = select_frames(node.shape[0], idx=idx, stride=stride,
+                               start=start, stop=stop)
+        num_channels = node.shape[1]
+
+    shape = tuple(ds_shape) + (num_channels, frames.size)
+    out = np.memmap(towrite, dtype=np.float32, mode="w+", shape=shape)
+    del out
+
+    # Tasks take frames in sorted order, so they rarely share chunks.
+    order = np.argsort(frames, kind="stable")
+    todo = [(path, name, frames[pos], pos, towrite, shape, tuple(ds_shape))
+            for pos in np.array_split(order, max(1, -(-frames.size // block)))]
+
+    done = 0
+    with multiprocessing.Pool(processes=nproc) as pool:
+        for k in pool.imap_unordered(downsample_task, todo):
+            done += k
+            print("Update:", done, "of", frames.size, "frames")
+
+    return np.memmap(towrite, dtype=np.float32, mode="r", shape=shape)